@@ -0,0 +1,6 @@
+"""
+Benchmarks of the processing steps on deterministic synthetic slides, e.g.
+
+    cd processing
+    python -m benchmarks -o bench.json --size 8192 8192 --cases erode quantification
+"""
@@ -0,0 +1,106 @@
+import argparse
+import datetime
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+from benchmarks import runner
+
+
+def parse_params(param_strs):
+    params = {}
+    for pp in param_strs or []:
+        key, value = pp.split('=', 1)
+        name, key = key.split('.', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        params.setdefault(name, {})[key] = value
+    return params
+
+
+def main(argv=sys.argv):
+    from benchmarks import cases
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description=(
+            'Benchmark processing steps on a synthetic slide; run from the'
+            ' processing directory'
+        )
+    )
+    parser.add_argument(
+        '-o', '--output', type=pathlib.Path, required=True,
+        help='JSON file to write the results to'
+    )
+    parser.add_argument(
+        '--cases', nargs='+', default=list(cases.CASES),
+        choices=list(cases.CASES)
+    )
+    parser.add_argument(
+        '--size', type=int, nargs=2, default=(4096, 4096), metavar=('H', 'W')
+    )
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--tissue-fraction', type=float, default=1.0,
+        help='fraction of the slide covered by cells, the rest is glass'
+    )
+    parser.add_argument(
+        '--param', action='append', metavar='CASE.KEY=VALUE',
+        help='extra keyword argument passed to a case, value parsed as JSON'
+    )
+    parser.add_argument(
+        '--work-dir', type=pathlib.Path, default=None,
+        help='where to write the synthetic slide and outputs; default to a temp dir'
+    )
+    args = parser.parse_args(argv[1:])
+
+    with tempfile.TemporaryDirectory(prefix='orion-benchmark-') as tmp_dir:
+        work_dir = args.work_dir or pathlib.Path(tmp_dir)
+        print('Generating synthetic slide', tuple(args.size), flush=True)
+        start_time = time.perf_counter()
+        paths = runner.generate_slide(
+            out_dir=work_dir / 'input', shape=tuple(args.size),
+            num_channels=args.channels, seed=args.seed,
+            tissue_fraction=args.tissue_fraction
+        )
+        print(f"    done in {time.perf_counter() - start_time:.1f} s", flush=True)
+
+        params = parse_params(args.param)
+        results = []
+        for name in args.cases:
+            out_dir = work_dir / name
+            out_dir.mkdir(exist_ok=True, parents=True)
+            print('Running', name, flush=True)
+            result = runner.run_case(name, paths, out_dir, params.get(name))
+            print(
+                f"    {result['status']} - {result['wall_time_s']:.1f} s,"
+                f" peak RSS {result['peak_rss_MB']:.0f} MB,"
+                f" {result.get('megapixels_per_s', 0):.1f} MP/s",
+                flush=True
+            )
+            results.append(result)
+
+    args.output.parent.mkdir(exist_ok=True, parents=True)
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'created': datetime.datetime.now().isoformat(),
+            'machine': runner.machine_info(),
+            'slide': {
+                'shape': list(args.size),
+                'channels': args.channels,
+                'seed': args.seed,
+                'tissue_fraction': args.tissue_fraction,
+            },
+            'results': results,
+        }, output_file, indent=2, default=str)
+    print('Results written to', args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import concurrent.futures
+import json
+import os
+import pathlib
+import runpy
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tifffile
+
+CURR = pathlib.Path(__file__).resolve().parent
+REPO = CURR.parent.parent
+
+CASES = {}
+
+
+def register(name):
+    def wrapper(func):
+        CASES[name] = func
+        return func
+    return wrapper
+
+
+def megapixels(img_path):
+    with tifffile.TiffFile(img_path) as tif:
+        shape = tif.series[0].shape
+    return shape[-2] * shape[-1] / 1e6
+
+
+def run_script(script_path, args):
+    if not pathlib.Path(script_path).exists():
+        raise ImportError(f"{script_path} not found")
+    sys_argv = sys.argv
+    sys.argv = [str(script_path), *[str(aa) for aa in args]]
+    try:
+        runpy.run_path(str(script_path), run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError(f"{script_path} exited with {e.code}")
+    finally:
+        sys.argv = sys_argv
+
+
+@register('unmicst')
+def unmicst(paths, out_dir, size_scaling_factor=0.5, **kwargs):
+    from module_scripts import unmicst_predict_once
+
+    unmicst_predict_once.process_slide(
+        img_path=paths['image'],
+        nucleus_channel=0,
+        size_scaling_factor=size_scaling_factor,
+        output_path=out_dir / 'pmap.ome.tif',
+        **kwargs
+    )
+    return {'megapixels': megapixels(paths['image'])}
+
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import numpy as np
+from module_scripts import unmicst_predict_once
+imported = time.perf_counter()
+engine = unmicst_predict_once.get_engine()
+engine.batch_size = 24
+loaded = time.perf_counter()
+engine.predict(np.zeros((256, 256), dtype=np.float32))
+predicted = time.perf_counter()
+print(json.dumps({
+    'import_s': imported - start,
+    'model_setup_s': loaded - imported,
+    'first_inference_s': predicted - loaded,
+}))
+'''
+
+
+@register('unmicst_startup')
+def unmicst_startup(paths, out_dir):
+    """Time from launching a python interpreter to the first UnMicst inference"""
+    start_time = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT, str(REPO / 'processing')],
+        capture_output=True, text=True
+    )
+    total = time.perf_counter() - start_time
+    if process.returncode != 0:
+        if 'No module named' in process.stderr:
+            raise ImportError(process.stderr.strip().splitlines()[-1])
+        raise RuntimeError(process.stderr)
+    return {
+        **json.loads(process.stdout.strip().splitlines()[-1]),
+        'launch_to_first_inference_s': total,
+    }
+
+
+@register('unmicst_inference_split')
+def unmicst_inference_split(
+    paths, out_dir, splits=None, tile_size=1024, batch_size=24
+):
+    """
+    Patches/s of UnMicst inference for each split of the CPUs into worker
+    processes x TensorFlow threads; `splits` is a list of [workers, threads]
+    """
+    from module_scripts import inference, unmicst_predict_once
+
+    img = tifffile.imread(paths['image'], key=0).astype(np.float32)
+    img /= img.max()
+    H, W = img.shape
+    tiles = [
+        img[y:y+tile_size, x:x+tile_size]
+        for y in range(0, H, tile_size)
+        for x in range(0, W, tile_size)
+    ]
+    if splits is None:
+        cpus = os.cpu_count()
+        splits = [
+            (2**ii, cpus // 2**ii) for ii in range(cpus.bit_length())
+            if 2**ii <= cpus
+        ]
+    engine = unmicst_predict_once.get_engine()
+    engine.batch_size = batch_size
+    results = []
+    for num_workers, num_threads in splits:
+        print(f"    {num_workers} worker(s) x {num_threads} thread(s)", flush=True)
+        pool = inference.InferencePool(
+            unmicst_predict_once.__name__, num_workers,
+            intra_op_threads=num_threads, inter_op_threads=1
+        )
+        with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+            # load the model in the workers before timing
+            list(executor.map(
+                lambda tile: pool.predict(engine, tile), tiles[:num_workers]
+            ))
+            engine.reset_stats()
+            start_time = time.perf_counter()
+            list(executor.map(
+                lambda tile: pool.predict(engine, tile, out_dtype=np.uint8),
+                tiles
+            ))
+            elapsed = time.perf_counter() - start_time
+        pool.close()
+        results.append({
+            'workers': num_workers,
+            'threads': num_threads,
+            'patches_per_s': engine.num_patches / elapsed,
+        })
+    return {
+        'splits': results,
+        'best': max(results, key=lambda rr: rr['patches_per_s']),
+    }
+
+
+@register('resample')
+def resample(paths, out_dir, scale=0.5):
+    """
+    Downscale the nucleus channel by `scale` and upscale 3-channel uint8 maps
+    back, with the kernels of `module_scripts.resample` and with
+    `dask_image.ndinterp.affine_transform`
+    """
+    import dask.array as da
+    import dask_image.ndinterp
+    from module_scripts import resample
+
+    img = da.from_array(tifffile.imread(paths['image'], key=0), chunks=2048)
+    H, W = img.shape
+    small_shape = tuple(np.ceil(scale * np.array([H, W])).astype(int))
+    maps = da.from_array(
+        np.random.default_rng(0).integers(
+            0, 255, size=(3, *small_shape), dtype=np.uint8
+        ),
+        chunks=(1, 1024, 1024)
+    )
+
+    def timed(arr):
+        start_time = time.perf_counter()
+        arr.compute()
+        return time.perf_counter() - start_time
+
+    mx = np.eye(3) * scale
+    mx[-1, -1] = 1
+    timings = {
+        'down_kernel_s': timed(
+            resample.rescale(img, scale, small_shape, output_chunks=1024)
+        ),
+        'down_affine_s': timed(dask_image.ndinterp.affine_transform(
+            img, matrix=np.linalg.inv(mx), output_chunks=(1024, 1024),
+            output_shape=small_shape
+        )),
+        'up_kernel_s': timed(
+            resample.rescale(maps, 1 / scale, (H, W), output_chunks=2048)
+        ),
+        'up_affine_s': timed(dask_image.ndinterp.affine_transform(
+            maps, matrix=np.roll(mx, 1, axis=(0, 1)),
+            output_chunks=(1, 2048, 2048), output_shape=(3, H, W)
+        )),
+    }
+    timings['down_speedup'] = timings['down_affine_s'] / timings['down_kernel_s']
+    timings['up_speedup'] = timings['up_affine_s'] / timings['up_kernel_s']
+    return {**timings, 'megapixels': 4 * H * W / 1e6}
+
+
+@register('erode')
+def erode(paths, out_dir, erode_size=3):
+    from module_scripts import erode_mask
+
+    erode_mask.process_slide(
+        nucleus_mask_path=paths['nucleiRing'],
+        cell_mask_path=paths['cellRing'],
+        erode_size=erode_size,
+        output_path=out_dir / 'cytoRing-eroded.ome.tif',
+    )
+    return {'megapixels': megapixels(paths['nucleiRing'])}
+
+
+@register('erode_engines')
+def erode_engines(paths, out_dir, erode_sizes=tuple(range(1, 11))):
+    """
+    Erode the nucleus mask with each engine of `module_scripts.erode_mask`
+    and with the previous implementation (skimage `binary_erosion` over all
+    chunks with a fixed 128-pixel overlap), for each erode size
+    """
+    import dask.array as da
+    import skimage.morphology
+    from module_scripts import erode_mask
+
+    nucleus = da.from_array(tifffile.imread(paths['nucleiRing']), chunks=1024)
+
+    def previous(mask, erode_size):
+        return mask.astype(bool).map_overlap(
+            skimage.morphology.binary_erosion,
+            footprint=skimage.morphology.disk(erode_size),
+            depth={0: 128, 1: 128},
+            boundary='none'
+        )
+
+    def timed(arr):
+        start_time = time.perf_counter()
+        result = arr.compute()
+        return time.perf_counter() - start_time, result
+
+    results = []
+    for erode_size in erode_sizes:
+        previous_s, expected = timed(previous(nucleus, erode_size))
+        result = {'erode_size': erode_size, 'previous_s': previous_s}
+        for engine in erode_mask.ENGINES:
+            elapsed, eroded = timed(
+                erode_mask.erode(nucleus, erode_size, engine=engine)
+            )
+            result[f"{engine}_s"] = elapsed
+            result[f"{engine}_speedup"] = previous_s / elapsed
+            result[f"{engine}_matches"] = bool(np.array_equal(eroded, expected))
+        results.append(result)
+    return {'erode_sizes': results, 'megapixels': megapixels(paths['nucleiRing'])}
+
+
+@register('pyramid_assemble')
+def pyramid_assemble(paths, out_dir, pixel_size=0.325):
+    out_path = out_dir / 'assembled.ome.tif'
+    run_script(
+        REPO / '.dev' / 'pyramid_assemble.py',
+        [*paths['channels'], out_path, '--pixel-size', pixel_size]
+    )
+    return {
+        'megapixels': len(paths['channels']) * megapixels(paths['channels'][0])
+    }
+
+
+@register('quantification')
+def quantification(paths, out_dir):
+    run_script(
+        REPO / 'modules' / 'quantification' / 'CommandSingleCellExtraction.py',
+        [
+            '--masks', paths['cellRing'], paths['nucleiRing'],
+            '--image', paths['image'],
+            '--output', out_dir,
+            '--channel_names', paths['markers'],
+        ]
+    )
+    with tifffile.TiffFile(paths['image']) as tif:
+        num_channels = tif.series[0].shape[0]
+    # every channel is read once per mask
+    return {'megapixels': 2 * num_channels * megapixels(paths['image'])}
+
+
+@register('quantification_tiled')
+def quantification_tiled(paths, out_dir, tile_size=4096):
+    from module_scripts import quantify
+
+    quantify.process_slide(
+        paths['image'],
+        [paths['cellRing'], paths['nucleiRing']],
+        paths['markers'],
+        out_dir,
+        tile_size=tile_size,
+    )
+    with tifffile.TiffFile(paths['image']) as tif:
+        num_channels = tif.series[0].shape[0]
+    # counted as in the `quantification` case so that the rates compare,
+    # although the image is read once for both masks
+    return {'megapixels': 2 * num_channels * megapixels(paths['image'])}
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import pathlib
+import platform
+import socket
+import time
+import traceback
+
+
+def generate_slide(**kwargs):
+    """
+    `synthetic.make_synthetic_slide` in a separate process, so that the
+    slide is not held by the process the cases are spawned from
+    """
+    from benchmarks import synthetic
+
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(synthetic.make_synthetic_slide, kwds=kwargs)
+
+
+def _run_case(name, paths, out_dir, params, queue):
+    import run_all_utils
+    from benchmarks import cases
+
+    result = {'case': name, 'params': params}
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        extra = cases.CASES[name](paths, pathlib.Path(out_dir), **params)
+        result['status'] = 'ok'
+    except ImportError as e:
+        extra = {}
+        result['status'] = f"skipped - {e!r}"
+    except Exception as e:
+        traceback.print_exc()
+        extra = {}
+        result['status'] = f"failed - {e!r}"
+    result['wall_time_s'] = time.perf_counter() - start_time
+    result['cpu_time_s'] = time.process_time() - start_cpu
+    result['peak_rss_MB'] = run_all_utils.peak_rss_MB()
+    result.update(extra)
+    if 'megapixels' in result:
+        result['megapixels_per_s'] = result['megapixels'] / result['wall_time_s']
+    queue.put(result)
+
+
+def run_case(name, paths, out_dir, params=None):
+    """
+    Run a benchmark case in a fresh process. Its peak RSS is read from
+    VmHWM, which starts over in the new process; ru_maxrss, the fallback
+    without /proc, carries over the peak of the process it was spawned from
+    """
+    if params is None:
+        params = {}
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(
+        target=_run_case, args=(name, paths, str(out_dir), params, queue)
+    )
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Exception:
+            if not process.is_alive():
+                result = {
+                    'case': name, 'params': params,
+                    'status': f"failed - process exited with {process.exitcode}",
+                    'wall_time_s': float('nan'), 'peak_rss_MB': float('nan'),
+                }
+                break
+    process.join()
+    return result
+
+
+def machine_info():
+    return {
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+    }
@@ -0,0 +1,172 @@
+import pathlib
+
+import numpy as np
+import tifffile
+
+
+def _nuclei_layout(shape, spacing, radius, seed, tissue_fraction):
+    """
+    One nucleus per `spacing` x `spacing` grid cell with a jittered center,
+    so that nuclei never overlap and label of a pixel is its grid cell index
+    """
+    rng = np.random.default_rng(seed)
+    grid_shape = np.ceil(np.divide(shape, spacing)).astype(int)
+    num_cells = grid_shape[0] * grid_shape[1]
+    margin = spacing / 2 - radius
+    assert margin >= 0, 'spacing must be at least twice the nucleus radius'
+    jitter = rng.uniform(-margin, margin, size=(num_cells, 2))
+    radii = rng.uniform(0.7, 1.0, size=num_cells) * radius
+    grid_y, grid_x = np.divmod(np.arange(num_cells), grid_shape[1])
+    centers = (np.stack([grid_y, grid_x], axis=1) + 0.5) * spacing + jitter
+    # nuclei only within a centered ellipse covering `tissue_fraction` of the
+    # slide, the rest is glass
+    h, w = shape
+    norm = ((centers[:, 0] - h / 2) / h)**2 + ((centers[:, 1] - w / 2) / w)**2
+    keep = norm <= tissue_fraction / np.pi
+    return grid_shape, centers, radii, keep
+
+
+def _render_rows(row_start, row_end, width, spacing, layout):
+    grid_shape, centers, radii, keep = layout
+    yy, xx = np.mgrid[row_start:row_end, 0:width]
+    cell_idx = (yy // spacing) * grid_shape[1] + (xx // spacing)
+    dist2 = (
+        (yy + 0.5 - centers[cell_idx, 0])**2
+        + (xx + 0.5 - centers[cell_idx, 1])**2
+    )
+    return cell_idx, dist2, radii[cell_idx], keep[cell_idx]
+
+
+def iter_slide_rows(
+    shape, num_channels=1, dtype=np.uint16, spacing=24, radius=8,
+    seed=0, tissue_fraction=1.0, rows_per_block=1024
+):
+    """
+    Yield (row_start, image block (C, rows, W), nucleus labels, cell labels)
+    of a synthetic slide; the first channel is nucleus-like and the other
+    channels mark random subsets of the cells
+    """
+    dtype = np.dtype(dtype)
+    dmax = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1.0
+    layout = _nuclei_layout(shape, spacing, radius, seed, tissue_fraction)
+    num_cells = len(layout[1])
+    rng = np.random.default_rng(seed + 1)
+    amplitudes = rng.uniform(0.2, 0.8, size=(num_channels, num_cells))
+    amplitudes[1:] *= rng.random((num_channels - 1, num_cells)) < 0.3
+    h, w = shape
+    for row_start in range(0, h, rows_per_block):
+        row_end = min(row_start + rows_per_block, h)
+        cell_idx, dist2, radii, keep = _render_rows(
+            row_start, row_end, w, spacing, layout
+        )
+        in_nucleus = keep & (dist2 <= radii**2)
+        in_cell = keep & (dist2 <= (1.6 * radii)**2)
+        labels = np.where(in_nucleus, cell_idx + 1, 0).astype(np.int32)
+        cell_labels = np.where(in_cell, cell_idx + 1, 0).astype(np.int32)
+        noise_rng = np.random.default_rng([seed, row_start])
+        falloff = np.exp(-dist2 / (2 * radii**2))
+        img = np.empty((num_channels, *labels.shape), dtype=dtype)
+        for channel in range(num_channels):
+            mask = in_nucleus if channel == 0 else in_cell
+            signal = np.where(mask, amplitudes[channel][cell_idx] * falloff, 0)
+            signal += noise_rng.normal(0.02, 0.005, size=signal.shape)
+            img[channel] = (np.clip(signal, 0, 1) * dmax).astype(dtype)
+        yield row_start, img, labels, cell_labels
+
+
+def _num_levels(shape, tile_size):
+    return max(int(np.ceil(np.log2(max(shape) / tile_size))) + 1, 1)
+
+
+def _downsample(img, is_mask):
+    if is_mask:
+        return img[..., ::2, ::2]
+    h, w = img.shape[-2:]
+    padded = np.pad(
+        img, [(0, 0)] * (img.ndim - 2) + [(0, h % 2), (0, w % 2)], mode='edge'
+    )
+    return (
+        padded.reshape(*padded.shape[:-2], (h + 1) // 2, 2, (w + 1) // 2, 2)
+        .mean(axis=(-3, -1))
+        .astype(img.dtype)
+    )
+
+
+def write_pyramid(img, path, pixel_size=0.325, tile_size=1024, is_mask=False):
+    """Write (C, Y, X) `img` as a tiled pyramidal OME-TIFF with sub-IFDs"""
+    if img.ndim == 2:
+        img = img[np.newaxis]
+    num_levels = _num_levels(img.shape[1:], tile_size)
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        options = dict(
+            tile=(tile_size, tile_size),
+            compression='zlib',
+            photometric='minisblack',
+            resolutionunit='CENTIMETER',
+        )
+        tif.write(
+            img,
+            subifds=num_levels - 1,
+            resolution=(1e4 / pixel_size, 1e4 / pixel_size),
+            metadata={
+                'axes': 'CYX',
+                'PhysicalSizeX': pixel_size,
+                'PhysicalSizeY': pixel_size,
+            },
+            **options
+        )
+        level_img = img
+        for level in range(1, num_levels):
+            level_img = _downsample(level_img, is_mask)
+            mag = 2**level
+            tif.write(
+                level_img,
+                subfiletype=1,
+                resolution=(1e4 / mag / pixel_size, 1e4 / mag / pixel_size),
+                **options
+            )
+    return pathlib.Path(path)
+
+
+def make_synthetic_slide(
+    out_dir, shape=(4096, 4096), num_channels=4, dtype=np.uint16,
+    spacing=24, radius=8, seed=0, tissue_fraction=1.0,
+    pixel_size=0.325, tile_size=1024
+):
+    """
+    Write a deterministic synthetic slide and its label masks as pyramidal
+    OME-TIFFs to `out_dir`; returns a dict of the written paths
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(exist_ok=True, parents=True)
+    h, w = shape
+    img = np.empty((num_channels, h, w), dtype=dtype)
+    nuclei = np.empty((h, w), dtype=np.int32)
+    cells = np.empty((h, w), dtype=np.int32)
+    for row_start, img_rows, nuclei_rows, cell_rows in iter_slide_rows(
+        shape, num_channels=num_channels, dtype=dtype, spacing=spacing,
+        radius=radius, seed=seed, tissue_fraction=tissue_fraction
+    ):
+        row_end = row_start + nuclei_rows.shape[0]
+        img[:, row_start:row_end] = img_rows
+        nuclei[row_start:row_end] = nuclei_rows
+        cells[row_start:row_end] = cell_rows
+
+    paths = {
+        'image': out_dir / 'synthetic.ome.tif',
+        'nucleiRing': out_dir / 'nucleiRing.ome.tif',
+        'cellRing': out_dir / 'cellRing.ome.tif',
+        'markers': out_dir / 'markers.csv',
+    }
+    write_pyramid(img, paths['image'], pixel_size, tile_size)
+    write_pyramid(nuclei, paths['nucleiRing'], pixel_size, tile_size, is_mask=True)
+    write_pyramid(cells, paths['cellRing'], pixel_size, tile_size, is_mask=True)
+    # single-channel plain TIFFs, inputs of .dev/pyramid_assemble.py
+    paths['channels'] = []
+    for channel in range(num_channels):
+        channel_path = out_dir / f"channel-{channel:02}.tif"
+        tifffile.imwrite(channel_path, img[channel], bigtiff=True)
+        paths['channels'].append(channel_path)
+    with open(paths['markers'], 'w') as marker_file:
+        marker_file.writelines(f"marker-{cc}\n" for cc in range(num_channels))
+    return paths
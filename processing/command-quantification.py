@@ -2,11 +2,8 @@ import argparse
 import datetime
 import os
 import pathlib
-import subprocess
 import sys
-import time
 
-import psutil
 import run_all_utils
 from joblib import Parallel, delayed
 
@@ -21,18 +18,16 @@ python ../modules/quantification/CommandSingleCellExtraction.py
 MODULE_NAME = 'quantification'
 ORION_DEFAULTS = [
     ('masks name pattern', '*cellRing*.ome.tif', ''),
-    ('channel_names', None, '')
+    ('channel_names', None, ''),
+    ('engine', 'mcmicro', ''),
 ]
+ENGINES = ('mcmicro', 'tiled')
 
 
-def estimate_RAM_usage(img_path, num_masks):
-    import tifffile
-    img_path = pathlib.Path(img_path)
-    with tifffile.TiffFile(img_path) as tif:
-        shape = tif.series[0].shape
-    shape = sorted(shape)[-2:]
-    ram_base = (shape[0] * shape[1] / 1024**2) / 1000
-    return (1+2+4*num_masks) * ram_base
+def estimate_RAM_usage(img_path, num_masks, engine='mcmicro'):
+    return run_all_utils.estimate_RAM_usage(
+        MODULE_NAME, img_path, {'num_masks': num_masks, 'engine': engine}
+    )
 
 
 def main(argv=sys.argv):
@@ -49,6 +44,11 @@ def main(argv=sys.argv):
         required=False,
         default=None
     )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='rerun slides even if the outputs are up to date'
+    )
     parsed_args = parser.parse_args(argv[1:])
     
     CURR = pathlib.Path(__file__).resolve().parent
@@ -60,11 +60,18 @@ def main(argv=sys.argv):
     assert module_params['channel_names'] is not None, 'channel_names is required'
     marker_csv_path = pathlib.Path(module_params['channel_names'])
     assert marker_csv_path.exists(), f"{marker_csv_path} does not exist"
+    engine = module_params['engine']
+    assert engine in ENGINES, f"engine must be one of {ENGINES}, got {engine}"
+    script_path = {
+        'mcmicro': CURR.parent / 'modules/quantification/CommandSingleCellExtraction.py',
+        'tiled': CURR / 'module_scripts/quantify.py',
+    }[engine]
 
     commands = []
     quant_out_dirs = []
     ram_usages = []
     image_paths = []
+    manifests = []
     for config in file_config[:]:
         config = run_all_utils.set_config_defaults(config)
 
@@ -84,52 +91,84 @@ def main(argv=sys.argv):
         quant_out_dir = out_dir / name / 'quantification'
         quant_out_dir.mkdir(exist_ok=True, parents=True)
 
+        manifest_path = run_all_utils.manifest_path(out_dir, name, MODULE_NAME)
+        input_paths = [img_path, *mask_paths, marker_csv_path]
+        if not parsed_args.force and run_all_utils.is_up_to_date(
+            manifest_path, input_paths, module_params
+        ):
+            print('Skipping', name, '- outputs are up to date')
+            print()
+            continue
+
         command_run = [
             'python',
-            CURR.parent / 'modules/quantification/CommandSingleCellExtraction.py',
+            script_path,
             '--image', config['path'],
             '--output', quant_out_dir,
             '--masks',
         ]
         command_run.extend(mask_paths)
         for kk, vv in module_params.items():
-            if ' ' not in kk:
+            if ' ' not in kk and kk != 'engine':
                 command_run.extend([f"--{kk}", str(vv)])
 
         commands.append(command_run)
         quant_out_dirs.append(quant_out_dir)
-        ram_usages.append(estimate_RAM_usage(config['path'], len(mask_paths)))
+        ram_usages.append(
+            estimate_RAM_usage(config['path'], len(mask_paths), engine=engine)
+        )
         image_paths.append(img_path)
+        manifests.append((manifest_path, input_paths))
 
-    def run(cmd, out_dir, image_path):
+    if len(commands) == 0:
+        return 0
+
+    def run(cmd, out_dir, image_path, manifest):
         name = out_dir.parent.name
         print('Start processing', name)
 
-        start_time = int(time.perf_counter())
+        telemetry = run_all_utils.Telemetry(MODULE_NAME, name, image_path)
+        start_timestamp = datetime.datetime.now().timestamp()
         with open(out_dir / 'quant.log', 'a') as f:
             f.write(f"{datetime.datetime.now()}\n")
-        with open(out_dir / 'quant.log', 'a') as f:
-            subprocess.run(cmd, stdout=f)
-        end_time = int(time.perf_counter())
+        with open(out_dir / 'quant.log', 'a') as f, telemetry.phase('quantification'):
+            returncode = run_all_utils.run_python_script(
+                cmd[1], cmd[2:], stdout=f
+            )
+
+        if returncode != 0:
+            print('Failed', name, '- see', out_dir / 'quant.log')
+            return returncode
+        manifest_path, input_paths = manifest
+        output_paths = [
+            pp for pp in sorted(out_dir.glob('*.csv'))
+            if pp.stat().st_mtime >= int(start_timestamp)
+        ]
+        run_all_utils.write_manifest(
+            manifest_path, input_paths, module_params, output_paths
+        )
 
-        print('Finished', name, '- time used', datetime.timedelta(seconds=end_time-start_time))
+        print('Finished', name, '- time used', datetime.timedelta(seconds=int(telemetry.elapsed)))
         print()
 
         run_all_utils.to_log(
-            log_path, image_path, end_time-start_time, module_params
+            log_path, telemetry, module_params,
+            input_paths=input_paths, output_paths=output_paths
         )
+        return 0
     
-    available_ram = psutil.virtual_memory().available / 1024**3
+    available_ram = run_all_utils.available_RAM_GB()
     n_jobs_max = int(available_ram // max(ram_usages))
     n_cpus = os.cpu_count()
-    n_jobs = min(n_jobs_max, n_cpus, len(file_config))
+    n_jobs = min(n_jobs_max, n_cpus, len(commands))
     if n_jobs == 0:
         n_jobs = 1
     
-    Parallel(n_jobs=n_jobs, backend='loky', verbose=1)(
-        delayed(run)(cmd, dir, ip) for cmd, dir, ip in zip(commands, quant_out_dirs, image_paths)
+    returncodes = Parallel(n_jobs=n_jobs, backend='loky', verbose=1)(
+        delayed(run)(cmd, dir, ip, mm)
+        for cmd, dir, ip, mm in zip(commands, quant_out_dirs, image_paths, manifests)
     )
-    return 0
+    return max(returncodes)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,12 @@
 import argparse
 import datetime
+import os
 import pathlib
-import subprocess
 import sys
-import time
+import traceback
 
 import run_all_utils
+from joblib import Parallel, delayed
 
 
 command = '''
@@ -34,6 +35,12 @@ ORION_DEFAULTS = [
 ]
 
 
+def estimate_RAM_usage(img_path, module_params, pmap_path):
+    return run_all_utils.estimate_RAM_usage(
+        MODULE_NAME, img_path, module_params, pmap_path=pmap_path
+    )
+
+
 def main(argv=sys.argv):
 
     parser = argparse.ArgumentParser()
@@ -48,6 +55,11 @@ def main(argv=sys.argv):
         required=False,
         default=None
     )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='rerun slides even if the outputs are up to date'
+    )
     parsed_args = parser.parse_args(argv[1:])
     
     CURR = pathlib.Path(__file__).resolve().parent
@@ -56,15 +68,41 @@ def main(argv=sys.argv):
         parsed_args, ORION_DEFAULTS, MODULE_NAME
     )
 
+    commands = []
+    configs = []
+    ram_usages = []
+    manifests = []
+    failures = []
     for config in file_config[:]:
         config = run_all_utils.set_config_defaults(config)
 
         name = config['name']
         out_dir = config['out_dir']
 
-        print('Processing', name)
         nucleus_channel = module_params['probMapChan'] - 1
         pmap_path = out_dir / name / 'unmicst2' / f'{name}_Probabilities_{nucleus_channel}.ome.tif'
+
+        manifest_path = run_all_utils.manifest_path(out_dir, name, MODULE_NAME)
+        input_paths = [config['path'], pmap_path]
+        if not parsed_args.force and run_all_utils.is_up_to_date(
+            manifest_path, input_paths, module_params
+        ):
+            print('Skipping', name, '- outputs are up to date')
+            print()
+            continue
+
+        # the unmicst step records the class of each channel of the probability
+        # maps, S3segmenter expects the nuclei map as the first channel
+        if pmap_path.exists():
+            pmap_classes = run_all_utils.read_ome_tiff_info(pmap_path)['channel_names']
+            if pmap_classes and pmap_classes[0] != 'nuclei':
+                print(
+                    'Failed', name, '- first channel of', pmap_path, 'is',
+                    pmap_classes[0], 'not nuclei; keep nuclei in the',
+                    'pmap_classes of the unmicst step'
+                )
+                failures.append((name, 'first pmap channel is not nuclei'))
+                continue
         command_run = [
             'python',
             CURR.parent / 'modules/S3segmenter/large/S3segmenter.py',
@@ -76,35 +114,85 @@ def main(argv=sys.argv):
         for kk, vv in module_params.items():
             if kk not in ["erode-size", "use-name-in-csv"]:
                 command_run.extend([f"--{kk}", str(vv)])
-        
-        start_time = int(time.perf_counter())
-        
-        result = subprocess.run(command_run)
-        if result.returncode != 0:
-            return result.returncode
+
+        try:
+            ram_usage = estimate_RAM_usage(config['path'], module_params, pmap_path)
+        except Exception as error:
+            print('Failed', name, '-', repr(error))
+            failures.append((name, repr(error)))
+            continue
+
+        commands.append(command_run)
+        configs.append(config)
+        ram_usages.append(ram_usage)
+        manifests.append((manifest_path, input_paths))
+
+    def run(cmd, config, manifest, log_output):
+        # an error of one slide must not stop the other slides of the batch
+        try:
+            return run_slide(cmd, config, manifest, log_output)
+        except Exception as error:
+            traceback.print_exc()
+            print('Failed', config['name'], '-', repr(error))
+            return 1, repr(error)
+
+    def run_slide(cmd, config, manifest, log_output):
+        name = config['name']
+        out_dir = config['out_dir']
+        print('Start processing', name)
+
+        telemetry = run_all_utils.Telemetry(MODULE_NAME, name, config['path'])
+
+        if log_output:
+            # slides run at the same time would interleave their output
+            s3seg_log_path = out_dir / name / 'segmentation' / 's3seg.log'
+            s3seg_log_path.parent.mkdir(exist_ok=True, parents=True)
+            with open(s3seg_log_path, 'a') as f:
+                f.write(f"{datetime.datetime.now()}\n")
+            with open(s3seg_log_path, 'a') as f, telemetry.phase('s3segmenter'):
+                returncode = run_all_utils.run_python_script(
+                    cmd[1], cmd[2:], stdout=f
+                )
+        else:
+            with telemetry.phase('s3segmenter'):
+                returncode = run_all_utils.run_python_script(cmd[1], cmd[2:])
+        if returncode != 0:
+            reason = f"S3segmenter exited with {returncode}"
+            if log_output:
+                reason += f", see {s3seg_log_path}"
+            print('Failed', name, '-', reason)
+            return returncode, reason
 
         img_name = pathlib.Path(config['path']).name.split('.')[0]
         segmentation_dir = out_dir / name / 'segmentation' / img_name
         
         if module_params["erode-size"] > 0:
-            subprocess.run(
-                [
-                    "python",
-                    CURR / "module_scripts/erode_mask.py",
-                    segmentation_dir / "nucleiRing.ome.tif",
-                    segmentation_dir / "cellRing.ome.tif",
-                    str(module_params["erode-size"]),
-                    segmentation_dir / "cytoRing-eroded.ome.tif",
-                ]
-            )
+            # run in this process so that its errors stop the slide
+            from module_scripts import erode_mask
+
+            eroded_path = segmentation_dir / "cytoRing-eroded.ome.tif"
+            try:
+                with telemetry.phase('erode'):
+                    erode_mask.process_slide(
+                        segmentation_dir / "nucleiRing.ome.tif",
+                        segmentation_dir / "cellRing.ome.tif",
+                        module_params["erode-size"],
+                        eroded_path,
+                    )
+            except Exception as error:
+                traceback.print_exc()
+                print('Failed', name, '- erode step:', error)
+                eroded_path.unlink(missing_ok=True)
+                return 1, f"erode step: {error}"
         
+        ori_names = [
+            "nucleiRing.ome.tif",
+            "cellRing.ome.tif",
+            "cytoRing.ome.tif",
+            "cytoRing-eroded.ome.tif"
+        ]
+        output_paths = []
         if module_params["use-name-in-csv"]:
-            ori_names = [
-                "nucleiRing.ome.tif",
-                "cellRing.ome.tif",
-                "cytoRing.ome.tif",
-                "cytoRing-eroded.ome.tif"
-            ]
             new_names = [f"{name}-{nn}" for nn in ori_names]
             for oo, nn in zip(ori_names, new_names):
                 ori_path = segmentation_dir / oo
@@ -114,17 +202,55 @@ def main(argv=sys.argv):
                     new_path.unlink()
                 if ori_path.exists():
                     ori_path.replace(new_path)
-    
-        end_time = int(time.perf_counter())
+                    output_paths.append(new_path)
+        else:
+            output_paths = [
+                segmentation_dir / oo for oo in ori_names
+                if (segmentation_dir / oo).exists()
+            ]
+
+        manifest_path, input_paths = manifest
+        run_all_utils.write_manifest(
+            manifest_path, input_paths, module_params, output_paths
+        )
 
-        print('elapsed', datetime.timedelta(seconds=end_time-start_time))
+        print('Finished', name, '- time used', datetime.timedelta(seconds=int(telemetry.elapsed)))
         print()
 
         run_all_utils.to_log(
-            log_path, config['path'], end_time-start_time, module_params
+            log_path, telemetry, module_params,
+            input_paths=input_paths, output_paths=output_paths
         )
+        return 0, None
+
+    results = []
+    if len(commands) > 0:
+        # as many slides at once as their estimated RAM fits in
+        available_ram = run_all_utils.available_RAM_GB()
+        n_jobs_max = int(available_ram // max(ram_usages))
+        n_cpus = os.cpu_count()
+        n_jobs = min(n_jobs_max, n_cpus, len(commands))
+        if n_jobs == 0:
+            n_jobs = 1
 
-    return 0
+        results = Parallel(n_jobs=n_jobs, backend='loky', verbose=1)(
+            delayed(run)(cmd, cc, mm, n_jobs > 1)
+            for cmd, cc, mm in zip(commands, configs, manifests)
+        )
+
+    # a failed slide does not stop the rest of the batch
+    num_slides = len(failures) + len(results)
+    failures.extend(
+        (cc['name'], reason)
+        for cc, (returncode, reason) in zip(configs, results)
+        if returncode != 0
+    )
+    if len(failures) == 0:
+        return 0
+    print(f"{len(failures)} of {num_slides} slides failed:")
+    for name, reason in failures:
+        print(' ', name, '-', reason)
+    return 1
 
 
 if __name__ == '__main__':
@@ -1,8 +1,10 @@
 import argparse
+import csv
 import datetime
+import json
+import os
 import pathlib
 import sys
-import time
 
 import run_all_utils
 from module_scripts import unmicst_predict_once as unmicst
@@ -17,7 +19,198 @@ ORION_DEFAULTS = [
     ('intensity_min', None, 'float'),
     ('intensity_max', None, 'float'),
     ('intensity_gamma', 0.8, 'float'),
+    ('percentile_level', 0, 'int'),
+    ('use_pyramid_level', True, 'boolean'),
+    ('intermediate_store', 'auto', ''),
+    ('scratch_dir', None, ''),
+    ('inference_batch_size', 0, 'int'),
+    ('inference_workers', 1, 'int'),
+    ('inference_intra_op_threads', 0, 'int'),
+    ('inference_inter_op_threads', 0, 'int'),
+    ('skip_background', False, 'boolean'),
+    ('pmap_classes', 'nuclei, contours, background', ''),
+    ('checkpoint', False, 'boolean'),
+    ('cohort_csv', None, ''),
 ]
+# how the step runs, not what it writes; left out of the manifests so that
+# changing them does not rerun the slides
+OPERATIONAL_PARAMS = (
+    'intermediate_store',
+    'scratch_dir',
+    'inference_batch_size',
+    'inference_workers',
+    'inference_intra_op_threads',
+    'inference_inter_op_threads',
+    'checkpoint',
+)
+
+
+def warm_up():
+    # called once by stage_worker.py, loads the model before the first slide
+    unmicst.get_engine()
+
+
+def read_sweep_csv(csv_path, module_params):
+    """
+    Parameter sets of a sweep, one per row of a csv whose columns are some of
+    `unmicst.SWEEP_PARAMS`; empty and missing values are the module params
+    """
+    with open(csv_path, newline='') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    param_sets = []
+    for row in rows:
+        row = {kk.strip(): (vv or '').strip() for kk, vv in row.items()}
+        unknown = set(row) - set(unmicst.SWEEP_PARAMS)
+        assert not unknown, (
+            f"{csv_path} columns must be some of {unmicst.SWEEP_PARAMS},"
+            f" not {sorted(unknown)}"
+        )
+        params = {kk: module_params[kk] for kk in unmicst.SWEEP_PARAMS}
+        params.update({kk: float(vv) for kk, vv in row.items() if vv != ''})
+        param_sets.append(params)
+    return param_sets
+
+
+def histogram_path(config, nucleus_channel):
+    name = config['name']
+    return (
+        config['out_dir'] / name / 'unmicst2'
+        / f"{name}_Histogram_{nucleus_channel}.npz"
+    )
+
+
+def intensity_summary(file_config, module_params):
+    """
+    Print the in_range percentiles of each slide and of all slides together
+    from the cached histograms of the nucleus channel, computing the missing
+    ones; returns the in_range of all slides
+    """
+    from module_scripts import intensity
+
+    nucleus_channel = module_params['nucleus_channel']
+    q = [
+        module_params['intensity_in_range_p0'],
+        module_params['intensity_in_range_p1']
+    ]
+    total, total_offset = None, None
+    rows = []
+    for config in file_config:
+        config = run_all_utils.set_config_defaults(config)
+        hist = unmicst.slide_histogram(
+            config['path'],
+            nucleus_channel,
+            histogram_path(config, nucleus_channel),
+            percentile_level=module_params['percentile_level']
+        )
+        assert hist is not None, (
+            f"{config['path']} is not an 8- or 16-bit image, its intensity"
+            " histogram cannot be cached"
+        )
+        counts, offset = hist
+        if total is None:
+            total, total_offset = counts.copy(), offset
+        else:
+            assert (len(counts), offset) == (len(total), total_offset), (
+                f"{config['path']} has a different pixel type than the other"
+                " slides"
+            )
+            total += counts
+        rows.append((
+            config['name'],
+            intensity.percentile_from_histogram(counts, q, offset=offset)
+        ))
+    rows.append(('(all slides)', intensity.percentile_from_histogram(
+        total, q, offset=total_offset
+    )))
+
+    name_width = max(len(name) for name, _ in rows)
+    print(f"{'name':<{name_width}}  {f'p{q[0]:g}':>10}  {f'p{q[1]:g}':>10}")
+    for name, (vmin, vmax) in rows:
+        print(f"{name:<{name_width}}  {vmin:>10.1f}  {vmax:>10.1f}")
+    print()
+    return rows[-1][1]
+
+
+def cohort_in_range(cohort_csv, module_params):
+    """
+    `intensity_summary` of the slides of `cohort_csv`, cached in
+    `<cohort_csv>.in_range.json` with the histogram keys of the slides and
+    the percentiles, so that it is computed once for the cohort rather than
+    for every slide processed; concurrent jobs wait for the one computing it
+    """
+    cohort_csv = pathlib.Path(cohort_csv).expanduser()
+    cohort_config = [
+        run_all_utils.set_config_defaults(config)
+        for config in run_all_utils.process_arg_path(cohort_csv)
+    ]
+    key = dict(
+        histograms=[
+            unmicst.slide_histogram_key(
+                config['path'],
+                module_params['nucleus_channel'],
+                percentile_level=module_params['percentile_level']
+            )
+            for config in cohort_config
+        ],
+        q=[
+            module_params['intensity_in_range_p0'],
+            module_params['intensity_in_range_p1']
+        ],
+    )
+    cache_path = cohort_csv.with_name(f"{cohort_csv.name}.in_range.json")
+
+    def read_cache():
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+            if cache['key'] == key:
+                print('Intensity range of the cohort in', cohort_csv, cache['in_range'])
+                return cache['in_range']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    in_range = read_cache()
+    if in_range is not None:
+        return in_range
+    lock_path = cache_path.with_name(f"{cache_path.name}.lock")
+    with run_all_utils.file_lock(lock_path):
+        # computed by another job while waiting for the lock
+        in_range = read_cache()
+        if in_range is not None:
+            return in_range
+        print('Intensity range of the cohort in', cohort_csv)
+        in_range = [
+            float(vv) for vv in intensity_summary(cohort_config, module_params)
+        ]
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'key': key, 'in_range': in_range}, cache_file)
+        os.replace(tmp_path, cache_path)
+    return in_range
+
+
+def run_sweep(parsed_args, file_config, module_params):
+    param_sets = read_sweep_csv(parsed_args.sweep, module_params)
+    for config in file_config:
+        config = run_all_utils.set_config_defaults(config)
+        name = config['name']
+        print('Sweeping', name, '-', len(param_sets), 'parameter sets')
+        unmicst.sweep(
+            img_path=config['path'],
+            nucleus_channel=module_params['nucleus_channel'],
+            param_sets=param_sets,
+            output_dir=config['out_dir'] / name / 'unmicst2-sweep',
+            name=name,
+            roi=parsed_args.roi,
+            size_scaling_factor=module_params['size_scaling_factor'],
+            percentile_level=module_params['percentile_level'],
+            use_pyramid_level=module_params['use_pyramid_level'],
+            inference_batch_size=module_params['inference_batch_size'],
+            pmap_classes=module_params['pmap_classes']
+        )
+        print()
+    return 0
 
 
 def main(argv=sys.argv):
@@ -34,6 +227,38 @@ def main(argv=sys.argv):
         required=False,
         default=None
     )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='rerun slides even if the outputs are up to date'
+    )
+    parser.add_argument(
+        '--sweep',
+        metavar='params-csv',
+        default=None,
+        help=(
+            'instead of processing the slides, write probability maps of each'
+            ' set of normalization parameters in this csv to'
+            ' <out_dir>/<name>/unmicst2-sweep'
+        )
+    )
+    parser.add_argument(
+        '--roi',
+        metavar=('Y', 'X', 'HEIGHT', 'WIDTH'),
+        nargs=4,
+        type=int,
+        default=None,
+        help='limit --sweep to a region, in full resolution pixels'
+    )
+    parser.add_argument(
+        '--intensity-summary',
+        action='store_true',
+        help=(
+            'instead of processing the slides, print the in_range percentiles'
+            ' of each slide and of all slides together, caching the nucleus'
+            ' channel histograms for later runs'
+        )
+    )
     parsed_args = parser.parse_args(argv[1:])
     
     CURR = pathlib.Path(__file__).resolve().parent
@@ -43,7 +268,32 @@ def main(argv=sys.argv):
     )
     # Go from 1-based indexing to 0-based indexing
     module_params['nucleus_channel'] -= 1
+    cohort_csv = module_params.pop('cohort_csv')
+    # fail before any slide is processed
+    run_all_utils.parse_pmap_classes(module_params['pmap_classes'])
+
+    if parsed_args.intensity_summary:
+        intensity_summary(file_config, module_params)
+        return 0
+
+    if parsed_args.sweep is not None:
+        return run_sweep(parsed_args, file_config, module_params)
 
+    # in_range shared by the slides of `cohort_csv`, from their cached
+    # histograms; the resolved values are recorded in the manifests
+    if (cohort_csv is not None) and (
+        None in (module_params['intensity_min'], module_params['intensity_max'])
+    ):
+        cohort_range = cohort_in_range(cohort_csv, module_params)
+        if module_params['intensity_min'] is None:
+            module_params['intensity_min'] = float(cohort_range[0])
+        if module_params['intensity_max'] is None:
+            module_params['intensity_max'] = float(cohort_range[1])
+
+    manifest_params = {
+        kk: vv for kk, vv in module_params.items()
+        if kk not in OPERATIONAL_PARAMS
+    }
     for config in file_config[:]:
         config = run_all_utils.set_config_defaults(config)
 
@@ -54,22 +304,35 @@ def main(argv=sys.argv):
         nucleus_channel = module_params['nucleus_channel']
         output_path = out_dir / name / 'unmicst2' / f'{name}_Probabilities_{nucleus_channel}.ome.tif'
         output_path.parent.mkdir(exist_ok=True, parents=True)
-        
+
+        manifest_path = run_all_utils.manifest_path(out_dir, name, MODULE_NAME)
+        if not parsed_args.force and run_all_utils.is_up_to_date(
+            manifest_path, [img_path], manifest_params
+        ):
+            print('Skipping', name, '- outputs are up to date')
+            print()
+            continue
         
         print('Processing', name)
-        start_time = int(time.perf_counter())
+        telemetry = run_all_utils.Telemetry(MODULE_NAME, name, img_path)
         unmicst.process_slide(
             img_path=img_path,
             output_path=output_path,
+            histogram_path=histogram_path(config, nucleus_channel),
+            telemetry=telemetry,
             **module_params
         )
-        end_time = int(time.perf_counter())
 
-        print('elapsed', datetime.timedelta(seconds=end_time-start_time))
+        run_all_utils.write_manifest(
+            manifest_path, [img_path], manifest_params, [output_path]
+        )
+
+        print('elapsed', datetime.timedelta(seconds=int(telemetry.elapsed)))
         print()
 
         run_all_utils.to_log(
-            log_path, img_path, end_time-start_time, module_params
+            log_path, telemetry, module_params,
+            input_paths=[img_path], output_paths=[output_path]
         )
 
     return 0
@@ -0,0 +1,74 @@
+import json
+import pathlib
+import shutil
+
+import dask
+import dask.diagnostics
+import numpy as np
+import zarr
+
+
+def _store_block(block, zarr_array, region, done_path):
+    zarr_array[region] = block
+    # the marker is written after the chunk so that an interrupted write is
+    # computed again
+    done_path.touch()
+    return 0
+
+
+class Checkpoint:
+    """
+    On-disk zarr arrays of a slide's intermediates with a record of the
+    completed chunks, so that an interrupted run only computes the missing
+    chunks. `key` is a JSON-serializable description of everything the
+    intermediates depend on; an existing checkpoint with a different key is
+    discarded
+    """
+
+    def __init__(self, directory, key):
+        self.directory = pathlib.Path(directory)
+        key = json.dumps(key, sort_keys=True, default=str)
+        key_path = self.directory / 'key.json'
+        if key_path.exists() and key_path.read_text() != key:
+            print('Discarding checkpoint of different parameters', self.directory)
+            shutil.rmtree(self.directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        key_path.write_text(key)
+
+    def to_zarr(self, name, da_img, num_workers=None):
+        """Compute the chunks of `da_img` not yet in the checkpoint `name`"""
+        zarr_array = zarr.open(
+            str(self.directory / f"{name}.zarr"),
+            mode='a',
+            shape=da_img.shape,
+            chunks=da_img.chunksize,
+            dtype=da_img.dtype
+        )
+        done_dir = self.directory / f"{name}.done"
+        done_dir.mkdir(exist_ok=True)
+
+        starts = [np.cumsum((0, *cc[:-1])) for cc in da_img.chunks]
+        delayed_blocks = da_img.to_delayed()
+        tasks = []
+        for idx in np.ndindex(*da_img.numblocks):
+            done_path = done_dir / '.'.join(map(str, idx))
+            if done_path.exists():
+                continue
+            region = tuple(
+                slice(ss[ii], ss[ii] + cc[ii])
+                for ss, cc, ii in zip(starts, da_img.chunks, idx)
+            )
+            tasks.append(dask.delayed(_store_block)(
+                delayed_blocks[idx], zarr_array, region, done_path
+            ))
+        num_blocks = int(np.prod(da_img.numblocks))
+        print(
+            f"{name}: {num_blocks - len(tasks)}/{num_blocks} chunks restored"
+            " from checkpoint"
+        )
+        with dask.diagnostics.ProgressBar():
+            dask.compute(*tasks, num_workers=num_workers)
+        return zarr_array
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,44 +1,160 @@
+import math
+import pathlib
+import tempfile
+
+import dask.array as da
+import numpy as np
 import palom
 import skimage.morphology
+import zarr
+
+from . import pyramid
+
+
+def _row_distance(block):
+    # distance along each row to the nearest background pixel, pixels beyond
+    # the block count as foreground
+    width = block.shape[1]
+    idx = np.arange(width, dtype=np.int32)
+    far = 2 * width + 1
+    # column of the nearest background pixel on the left and on the right,
+    # foreground pixels are set out of reach without branching
+    left = idx - (idx + far) * block
+    np.maximum.accumulate(left, axis=1, out=left)
+    right = idx + (far - idx) * block
+    right = np.minimum.accumulate(right[:, ::-1], axis=1)[:, ::-1]
+    return np.minimum(idx - left, right - idx)
+
+
+def _erode_lines(block, erode_size):
+    # the disk is the union of the horizontal lines at rows -r..r, a pixel
+    # is kept if the row distance at each row offset dy is beyond the half
+    # width of that line, floor(sqrt(r^2 - dy^2)); the row distances are
+    # computed once, then each of the 2r line offsets is one boolean AND, so
+    # the cost per pixel is O(r) instead of the O(r^2) of the footprint. A
+    # full euclidean distance transform, O(1) in r, was ~5x slower per chunk
+    distance = _row_distance(block)
+    eroded = distance > erode_size
+    for dy in range(1, erode_size + 1):
+        kept = distance > math.isqrt(erode_size**2 - dy**2)
+        eroded[dy:] &= kept[:-dy]
+        eroded[:-dy] &= kept[dy:]
+    return eroded
+
+
+def _erode_footprint(block, erode_size):
+    return skimage.morphology.binary_erosion(
+        block, footprint=skimage.morphology.disk(erode_size)
+    )
 
 
-def process_slide(
-    nucleus_mask_path, cell_mask_path, erode_size, output_path, _overlap_size=128
-):
+ENGINES = {
+    "lines": _erode_lines,
+    "footprint": _erode_footprint,
+}
+
+
+def _erode_block(block, erode_size, engine):
+    # no nuclei, nothing to erode
+    if not block.any():
+        return np.zeros(block.shape, dtype=bool)
+    return ENGINES[engine](block, erode_size)
+
+
+def erode(mask, erode_size, engine="lines"):
+    """
+    Binary erosion of a 2D dask array by a disk of radius `erode_size`,
+    pixels outside the image count as foreground. "lines" erodes by the
+    horizontal lines making up the disk from one row distance transform,
+    with a cost growing linearly with the radius, "footprint" is skimage's
+    `binary_erosion`, whose cost grows with the disk area; both give the
+    same result. Chunks without foreground are not
+    processed
+    """
+    assert engine in ENGINES, f"engine must be one of {list(ENGINES)}"
     assert erode_size > 0
     assert erode_size == int(erode_size)
+    erode_size = int(erode_size)
+    # only pixels within the radius affect the result
+    return mask.astype(bool).map_overlap(
+        _erode_block,
+        erode_size=erode_size,
+        engine=engine,
+        depth={0: erode_size, 1: erode_size},
+        boundary="none",
+        dtype=bool,
+    )
+
+
+def process_slide(
+    nucleus_mask_path,
+    cell_mask_path,
+    erode_size,
+    output_path,
+    engine="lines",
+    maxworkers=None,
+    scratch_dir=None,
+):
+    """
+    Write the cell mask minus the eroded nuclei to a pyramidal OME-TIFF.
+    The mask is computed once to a temporary zarr array under `scratch_dir`
+    (the system temporary directory by default, preferably a fast local
+    drive rather than the output's network share), the pyramid levels are
+    then read from it band by band while the previous band is written and
+    `maxworkers` threads compress the tiles
+    """
     r1 = palom.reader.OmePyramidReader(nucleus_mask_path)
     r2 = palom.reader.OmePyramidReader(cell_mask_path)
 
     nucleus = r1.pyramid[0][0]
     cell = r2.pyramid[0][0]
-    eroded = nucleus.astype(bool).map_overlap(
-        skimage.morphology.binary_erosion,
-        footprint=skimage.morphology.disk(erode_size),
-        depth={0: _overlap_size, 1: _overlap_size},
-    )
+    eroded = erode(nucleus, erode_size, engine=engine)
 
     mask = cell - (nucleus * eroded)
 
-    palom.pyramid.write_pyramid(
-        [mask],
-        output_path,
-        pixel_size=r1.pixel_size,
-        downscale_factor=2,
-        compression="zlib",
-        is_mask=True,
-        save_RAM=True,
-    )
+    output_path = pathlib.Path(output_path)
+    if scratch_dir is not None:
+        scratch_dir = pathlib.Path(scratch_dir).expanduser()
+        scratch_dir.mkdir(exist_ok=True, parents=True)
+    # without it every pyramid level would erode the full resolution mask
+    with tempfile.TemporaryDirectory(
+        prefix="erode-", dir=scratch_dir
+    ) as tmp_dir:
+        zarr_mask = zarr.open(
+            str(pathlib.Path(tmp_dir) / "mask.zarr"),
+            mode="w",
+            shape=mask.shape,
+            chunks=mask.chunksize,
+            dtype=mask.dtype,
+        )
+        mask.to_zarr(zarr_mask)
+        levels = pyramid.pyramid_levels(
+            da.from_zarr(zarr_mask)[np.newaxis],
+            downscale_factor=2,
+            is_mask=True,
+        )
+        pyramid.write_pyramid(
+            levels,
+            output_path,
+            pixel_size=r1.pixel_size,
+            tile_size=1024,
+            compression="zlib",
+            downscale_factor=2,
+            maxworkers=maxworkers,
+        )
 
 
 import argparse
-import pathlib
 import sys
 
 
 def get_parser():
-    """Creates and returns an argument parser for the erode_mask.py script."""
+    """
+    Creates and returns an argument parser for the erode_mask.py script, run
+    as `python -m module_scripts.erode_mask` from the processing directory.
+    """
     parser = argparse.ArgumentParser(
+        prog="python -m module_scripts.erode_mask",
         description="Erodes a nucleus mask and processes it against a cell mask."
     )
 
@@ -66,6 +182,23 @@ def get_parser():
         help="Path to save the processed mask (OME-TIFF file).",
     )
 
+    parser.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="lines",
+        help="Erosion implementation, both give the same mask.",
+    )
+
+    parser.add_argument(
+        "--scratch-dir",
+        type=pathlib.Path,
+        default=None,
+        help=(
+            "Directory for the temporary full resolution mask, preferably on"
+            " a fast local drive; default to the system temporary directory."
+        ),
+    )
+
     return parser
 
 
@@ -78,6 +211,8 @@ def main(argv=sys.argv):
         cell_mask_path=args.cell_mask_path,
         erode_size=args.erode_size,
         output_path=args.output_path,
+        engine=args.engine,
+        scratch_dir=args.scratch_dir,
     )
 
 
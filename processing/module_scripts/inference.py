@@ -0,0 +1,207 @@
+import concurrent.futures
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+
+import numpy as np
+import skimage.exposure
+import skimage.util
+
+from . import rowit
+
+
+class InferenceEngine:
+    """
+    Run a patch-based model over an image in batches. `predict_batch` takes a
+    float32 (N, patch_size, patch_size, num_channels) batch and returns the
+    (N, patch_size, patch_size, num_classes) predictions. Input batches are
+    preallocated once per thread and reused
+    """
+
+    def __init__(
+        self,
+        predict_batch,
+        num_channels=2,
+        patch_size=128,
+        batch_size=None,
+        fixed_batch_size=False,
+        mean=0.18,
+        std=0.17,
+    ):
+        self.predict_batch = predict_batch
+        self.num_channels = num_channels
+        self.patch_size = patch_size
+        # when the model only accepts full batches, the unused rows of the
+        # last batch are left over from the previous batch
+        self.fixed_batch_size = fixed_batch_size
+        self.mean = mean
+        self.std = std
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_patches = 0
+        self.inference_time = 0
+
+    def add_stats(self, num_patches, inference_time):
+        with self._lock:
+            self.num_patches += num_patches
+            self.inference_time += inference_time
+
+    @property
+    def patches_per_s(self):
+        if self.inference_time == 0:
+            return 0
+        return self.num_patches / self.inference_time
+
+    def _buffer(self):
+        batch = getattr(self._local, 'batch', None)
+        if (batch is None) or (len(batch) != self.batch_size):
+            batch = np.empty(
+                (self.batch_size, self.patch_size, self.patch_size, self.num_channels),
+                dtype=np.float32
+            )
+            self._local.batch = batch
+        return batch
+
+    def _run(self, batch, num_patches):
+        feed = batch if self.fixed_batch_size else batch[:num_patches]
+        start = time.perf_counter()
+        output = self.predict_batch(feed)[:num_patches]
+        self.add_stats(num_patches, time.perf_counter() - start)
+        return output
+
+    def tune_batch_size(
+        self, candidates=(8, 16, 24, 32, 48, 64, 96, 128), num_patches=256
+    ):
+        """Set `batch_size` to the candidate with the highest patches/s"""
+        rng = np.random.default_rng(0)
+        throughputs = {}
+        for batch_size in candidates:
+            batch = rng.random(
+                (batch_size, self.patch_size, self.patch_size, self.num_channels),
+                dtype=np.float32
+            )
+            # first call of a new batch shape is not representative
+            self.predict_batch(batch)
+            num_batches = int(np.ceil(num_patches / batch_size))
+            start = time.perf_counter()
+            for _ in range(num_batches):
+                self.predict_batch(batch)
+            throughputs[batch_size] = (
+                num_batches * batch_size / (time.perf_counter() - start)
+            )
+        self.batch_size = max(throughputs, key=throughputs.get)
+        print(
+            'Inference batch size', self.batch_size, '-',
+            ', '.join(f"{kk}: {vv:.0f}" for kk, vv in throughputs.items()),
+            'patches/s'
+        )
+        return throughputs
+
+    def predict(self, img, border_size=24, out_dtype=None):
+        """
+        Predict a (C, Y, X) or (Y, X) image; channels are cycled through when
+        the image has fewer channels than the model input, so a single
+        channel image is fed as `num_channels` identical channels. Returns
+        (num_classes, Y, X)
+        """
+        if self.batch_size is None:
+            self.tune_batch_size()
+        if img.ndim == 2:
+            img = img[np.newaxis]
+        img = img[:self.num_channels]
+        assert border_size >= 0
+        border_size = int(border_size)
+        _, Y, X = img.shape
+
+        wv_cfg = rowit.WindowView((Y, X), self.patch_size, 2*border_size)
+        wv_imgs = [wv_cfg.window_view_list(channel) for channel in img]
+        n_patches = len(wv_imgs[0])
+
+        start = border_size if border_size > 0 else None
+        end = -border_size if border_size > 0 else None
+        batch = self._buffer()
+        output = None
+        for i in range(0, n_patches, self.batch_size):
+            n_sub_patches = min(self.batch_size, n_patches - i)
+            for cc in range(self.num_channels):
+                batch[:n_sub_patches, ..., cc] = wv_imgs[cc % len(wv_imgs)][i:i+n_sub_patches]
+            batch[:n_sub_patches] -= self.mean
+            batch[:n_sub_patches] /= self.std
+            predicted = self._run(batch, n_sub_patches)[:, start:end, start:end]
+            if output is None:
+                output = np.empty(
+                    (n_patches, *predicted.shape[1:]), dtype=np.float32
+                )
+            output[i:i+n_sub_patches] = predicted
+        output = skimage.util.montage(
+            output,
+            grid_shape=wv_cfg.window_view_shape[:2],
+            channel_axis=3
+        )[:Y, :X]
+        if out_dtype is not None:
+            output = skimage.exposure.rescale_intensity(
+                output, in_range=(0, 1), out_range=out_dtype
+            ).astype(out_dtype)
+        return np.moveaxis(output, 2, 0)
+
+
+def _init_worker(env):
+    # before the first call imports TensorFlow
+    os.environ.update(env)
+
+
+def _predict_in_worker(module_name, batch_size, img, kwargs):
+    # the model is loaded at the first call in each worker
+    engine = importlib.import_module(module_name).get_engine()
+    engine.batch_size = batch_size
+    engine.reset_stats()
+    output = engine.predict(img, **kwargs)
+    return output, engine.num_patches, engine.inference_time
+
+
+class InferencePool:
+    """
+    Spread `InferenceEngine.predict` calls over `num_workers` processes, each
+    loading its own copy of the model from `module_name`, which must have a
+    `get_engine()` function. TensorFlow reads its thread pool sizes from the
+    environment when it starts, so the workers set
+    TF_NUM_INTRAOP_THREADS/TF_NUM_INTEROP_THREADS before loading it; 0 leaves
+    TensorFlow's default. The environment of this process is not changed
+    """
+
+    def __init__(
+        self, module_name, num_workers, intra_op_threads=0, inter_op_threads=0
+    ):
+        self.module_name = module_name
+        self.num_workers = num_workers
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        env = {}
+        if intra_op_threads > 0:
+            env['TF_NUM_INTRAOP_THREADS'] = str(intra_op_threads)
+            env['OMP_NUM_THREADS'] = str(intra_op_threads)
+        if inter_op_threads > 0:
+            env['TF_NUM_INTEROP_THREADS'] = str(inter_op_threads)
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(env,)
+        )
+
+    def predict(self, engine, img, **kwargs):
+        """Same as `engine.predict(img, **kwargs)`, run in a worker process"""
+        output, num_patches, inference_time = self.executor.submit(
+            _predict_in_worker, self.module_name, engine.batch_size, img, kwargs
+        ).result()
+        engine.add_stats(num_patches, inference_time)
+        return output
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,134 @@
+import functools
+import os
+import pathlib
+
+import dask.array as da
+import numpy as np
+import tifffile
+import zarr
+
+
+def _histogram_range(dtype):
+    dtype = np.dtype(dtype)
+    assert np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2, (
+        f"histogram percentiles need 8- or 16-bit integer images, got {dtype}"
+    )
+    info = np.iinfo(dtype)
+    return int(info.min), int(info.max) - int(info.min) + 1
+
+
+def _block_histogram(block, offset, num_bins):
+    values = block.ravel()
+    if offset != 0:
+        values = values.astype(np.int32) - offset
+    return np.bincount(values, minlength=num_bins)[np.newaxis, np.newaxis]
+
+
+def histogram(da_img):
+    """
+    Pixel counts of every possible value of a 2D 8- or 16-bit dask array,
+    computed block by block so that only one block per worker is in memory;
+    returns (counts, offset) where counts[i] is the number of pixels with
+    value i + offset
+    """
+    assert da_img.ndim == 2
+    offset, num_bins = _histogram_range(da_img.dtype)
+    block_hists = da_img.map_blocks(
+        _block_histogram,
+        offset=offset,
+        num_bins=num_bins,
+        new_axis=2,
+        chunks=(
+            (1,) * da_img.numblocks[0], (1,) * da_img.numblocks[1], (num_bins,)
+        ),
+        dtype=np.int64
+    )
+    return block_hists.sum(axis=(0, 1)).compute(), offset
+
+
+def cached_histogram(da_img, cache_path, key):
+    """
+    `histogram(da_img)`, saved to the .npz `cache_path` with `key`, a string
+    identifying the image; a cache of the same key is read instead of
+    computing it again
+    """
+    cache_path = pathlib.Path(cache_path)
+    if cache_path.exists():
+        try:
+            with np.load(cache_path) as cache:
+                if str(cache['key']) == key:
+                    return cache['counts'], int(cache['offset'])
+        except (OSError, ValueError, KeyError):
+            pass
+    counts, offset = histogram(da_img)
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    # written under another name first so that a partial file is never read
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as tmp_file:
+        np.savez_compressed(tmp_file, counts=counts, offset=offset, key=key)
+    os.replace(tmp_path, cache_path)
+    return counts, offset
+
+
+def percentile_from_histogram(counts, q, offset=0):
+    """
+    Same as `np.percentile(img, q)` (linear interpolation) but from the
+    value counts of `img`
+    """
+    cumsum = np.cumsum(counts)
+    num_values = cumsum[-1]
+    assert num_values > 0, 'empty histogram'
+    rank = np.asarray(q, dtype=float) / 100 * (num_values - 1)
+    lower = np.floor(rank)
+    upper = np.minimum(lower + 1, num_values - 1)
+    # value of the k-th (0-based) smallest pixel
+    v_lower = np.searchsorted(cumsum, lower, side='right')
+    v_upper = np.searchsorted(cumsum, upper, side='right')
+    return offset + v_lower + (rank - lower) * (v_upper - v_lower)
+
+
+def has_histogram(dtype):
+    return np.issubdtype(dtype, np.integer) and np.dtype(dtype).itemsize <= 2
+
+
+def percentile(da_img, q):
+    if not has_histogram(da_img.dtype):
+        # no exact histogram, fall back to sorting the (in-memory) pixels
+        return np.percentile(da_img.compute(), q)
+    counts, offset = histogram(da_img)
+    return percentile_from_histogram(counts, q, offset=offset)
+
+
+def percentile_function(da_img):
+    """
+    `percentile(da_img, q)` as a function of `q`; the image is read at the
+    first call only, for percentiles that are not all known at once
+    """
+    @functools.lru_cache(maxsize=None)
+    def read():
+        if not has_histogram(da_img.dtype):
+            return da_img.compute(), None
+        return histogram(da_img)
+
+    def percentile_q(q):
+        values, offset = read()
+        if offset is None:
+            return np.percentile(values, q)
+        return percentile_from_histogram(values, q, offset=offset)
+
+    return percentile_q
+
+
+def read_level(img_path, channel, level=0, chunks=2048):
+    """
+    Dask array of one channel at a pyramid level of an (OME-)TIFF, the lowest
+    resolution level is used if `level` is beyond it
+    """
+    with tifffile.TiffFile(img_path) as tif:
+        level = min(level, len(tif.series[0].levels) - 1)
+    store = tifffile.imread(img_path, aszarr=True, series=0, level=level)
+    img = zarr.open(store, mode='r')
+    if img.ndim == 3:
+        return da.from_zarr(img, chunks=(1, chunks, chunks))[channel]
+    assert channel == 0
+    return da.from_zarr(img, chunks=chunks)
@@ -0,0 +1,134 @@
+import concurrent.futures
+import fractions
+import math
+
+import tifffile
+
+from . import resample
+
+
+def pyramid_shapes(base_shape, downscale_factor=2, max_size=1024):
+    """Shapes of the levels until the longer side is at most `max_size`"""
+    factor = max(base_shape) / max_size
+    num_levels = max(math.ceil(math.log(factor, downscale_factor)) + 1, 1)
+    return [
+        tuple(int(math.ceil(ss / downscale_factor**ll)) for ss in base_shape)
+        for ll in range(num_levels)
+    ]
+
+
+def pyramid_levels(
+    full_res, sources=(), downscale_factor=2, max_size=1024, is_mask=False
+):
+    """
+    Dask arrays (C, Y, X) of the pyramid levels of `full_res`. `sources` are
+    (scale, array) pairs of the same image at lower resolutions, e.g. the
+    output of a model run at scale 0.5; each level is block-mean downsampled
+    from the lowest resolution source it is an integer factor of, so that
+    sub-resolution levels do not need `full_res` to be computed. Label
+    masks (`is_mask`) are subsampled instead of averaged
+    """
+    shapes = pyramid_shapes(
+        full_res.shape[-2:], downscale_factor=downscale_factor, max_size=max_size
+    )
+    sources = sorted(
+        [(fractions.Fraction(1), full_res)]
+        + [(fractions.Fraction(ss).limit_denominator(64), aa) for ss, aa in sources],
+        key=lambda source: source[0]
+    )
+    levels = [full_res]
+    for level, shape in enumerate(shapes[1:], start=1):
+        scale = fractions.Fraction(1, downscale_factor**level)
+        for source_scale, source in sources:
+            ratio = source_scale / scale
+            if ratio.denominator == 1:
+                break
+        if is_mask:
+            factor = ratio.numerator
+            levels.append(resample.match_shape(
+                source[..., ::factor, ::factor], shape
+            ))
+            continue
+        img = resample.downsample(source, ratio.numerator)
+        if img.dtype != full_res.dtype:
+            img = img.round().astype(full_res.dtype)
+        levels.append(resample.match_shape(img, shape))
+    return levels
+
+
+def _tiles(img, tile_size):
+    # compute a band of tile rows at a time, per channel; the next band is
+    # read and computed while the tiles of the current one are written
+    band_size = tile_size * max(img.chunksize[-2] // tile_size, 1)
+    img = img.rechunk((1, band_size, img.chunksize[-1]))
+    bands = [
+        img[cc, y:y+band_size]
+        for cc in range(img.shape[0])
+        for y in range(0, img.shape[1], band_size)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_band = executor.submit(bands[0].compute)
+        for idx in range(len(bands)):
+            band = next_band.result()
+            if idx + 1 < len(bands):
+                next_band = executor.submit(bands[idx + 1].compute)
+            for yy in range(0, band.shape[0], tile_size):
+                for xx in range(0, band.shape[1], tile_size):
+                    yield band[yy:yy+tile_size, xx:xx+tile_size]
+
+
+def write_pyramid(
+    levels,
+    output_path,
+    pixel_size=1,
+    tile_size=1024,
+    compression='zlib',
+    software=None,
+    downscale_factor=2,
+    channel_names=None,
+    maxworkers=None,
+):
+    """
+    Write dask arrays (C, Y, X) `levels`, full resolution first, to a tiled
+    pyramidal OME-TIFF with the lower resolutions in sub-IFDs; `maxworkers`
+    threads compress the tiles, None lets tifffile choose
+    """
+    full_res = levels[0]
+    ome_metadata = {
+        'Creator': software,
+        'Pixels': {
+            'PhysicalSizeX': pixel_size,
+            'PhysicalSizeXUnit': 'µm',
+            'PhysicalSizeY': pixel_size,
+            'PhysicalSizeYUnit': 'µm',
+        },
+    }
+    if channel_names is not None:
+        assert len(channel_names) == full_res.shape[0]
+        ome_metadata['Channel'] = {'Name': list(channel_names)}
+    kwargs = dict(
+        software=software,
+        compression=compression,
+        resolutionunit='CENTIMETER',
+        dtype=full_res.dtype,
+        tile=(tile_size, tile_size),
+        maxworkers=maxworkers,
+    )
+    with tifffile.TiffWriter(output_path, bigtiff=True) as tif:
+        tif.write(
+            data=_tiles(full_res, tile_size),
+            shape=full_res.shape,
+            subifds=len(levels) - 1,
+            metadata=ome_metadata,
+            resolution=(1e4 / pixel_size, 1e4 / pixel_size),
+            **kwargs
+        )
+        for level, img in enumerate(levels[1:], start=1):
+            mag = downscale_factor**level
+            tif.write(
+                data=_tiles(img, tile_size),
+                shape=img.shape,
+                subfiletype=1,
+                resolution=(1e4 / mag / pixel_size, 1e4 / mag / pixel_size),
+                **kwargs
+            )
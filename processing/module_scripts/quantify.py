@@ -0,0 +1,325 @@
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+import skimage.measure
+import tifffile
+
+
+MORPHOLOGY = {
+    'Area': 'area',
+    'MajorAxisLength': 'axis_major_length',
+    'MinorAxisLength': 'axis_minor_length',
+    'Eccentricity': 'eccentricity',
+    'Solidity': 'solidity',
+    'Extent': 'extent',
+    'Orientation': 'orientation',
+}
+
+
+class TileReader:
+    """
+    Regions of the full resolution pages of an (OME-)TIFF, decoding only the
+    tiles (or strips) that overlap the region instead of the whole page
+    """
+
+    def __init__(self, path):
+        self.tif = tifffile.TiffFile(path)
+        self.pages = self.tif.series[0].pages
+        self.shape = self.tif.series[0].shape[-2:]
+
+    def read(self, page_idx, y0, y1, x0, x1):
+        page = self.pages[page_idx]
+        keyframe = page.keyframe
+        if keyframe.is_tiled:
+            seg_h, seg_w = keyframe.tilelength, keyframe.tilewidth
+        else:
+            seg_h, seg_w = keyframe.rowsperstrip, keyframe.imagewidth
+        num_cols = -(-keyframe.imagewidth // seg_w)
+        indices = [
+            rr * num_cols + cc
+            for rr in range(y0 // seg_h, -(-y1 // seg_h))
+            for cc in range(x0 // seg_w, -(-x1 // seg_w))
+        ]
+        out = np.zeros((y1 - y0, x1 - x0), dtype=keyframe.dtype)
+        # `read_segments` yields positions in the given lists; its `indices`
+        # argument is not applied consistently for a single segment, so the
+        # positions are mapped back to the segment indices of the page here
+        segments = self.tif.filehandle.read_segments(
+            [page.dataoffsets[ii] for ii in indices],
+            [page.databytecounts[ii] for ii in indices],
+            sort=True
+        )
+        for data, position in segments:
+            segment, (*_, sy, sx, _), _ = keyframe.decode(
+                data, indices[position], jpegtables=keyframe.jpegtables
+            )
+            if segment is None:
+                # segment not written in the file, left as 0
+                continue
+            # tiles at the image edges are padded
+            segment = segment.reshape(segment.shape[-3:-1])
+            top, left = max(y0, sy), max(x0, sx)
+            bottom = min(y1, sy + segment.shape[0], keyframe.imagelength)
+            right = min(x1, sx + segment.shape[1], keyframe.imagewidth)
+            out[top-y0:bottom-y0, left-x0:right-x0] = (
+                segment[top-sy:bottom-sy, left-sx:right-sx]
+            )
+        return out
+
+    def close(self):
+        self.tif.close()
+
+
+def tile_origins(shape, tile_size):
+    return [
+        (y, x)
+        for y in range(0, shape[0], tile_size)
+        for x in range(0, shape[1], tile_size)
+    ]
+
+
+def _grow(arr, size, fill=0):
+    # accumulators are indexed by label, the largest label is only known
+    # once the whole mask has been read
+    if arr.shape[-1] >= size:
+        return arr
+    size = max(size, 2 * arr.shape[-1])
+    grown = np.full((*arr.shape[:-1], size), fill, dtype=arr.dtype)
+    grown[..., :arr.shape[-1]] = arr
+    return grown
+
+
+class LabelStats:
+    """
+    Per-label pixel counts, intensity sums of each channel and bounding boxes
+    of a label mask, accumulated tile by tile with `np.bincount`
+    """
+
+    def __init__(self, num_channels):
+        self.counts = np.zeros(1, dtype=np.int64)
+        self.sums = np.zeros((num_channels, 1), dtype=np.float64)
+        self.bbox_min = np.full((2, 1), np.iinfo(np.int64).max, dtype=np.int64)
+        self.bbox_max = np.zeros((2, 1), dtype=np.int64)
+
+    def add_mask_tile(self, mask, y0, x0):
+        """Count the labels of a mask tile at (y0, x0); returns the tile index"""
+        hi = int(mask.max())
+        if hi == 0:
+            return None
+        lo = int(np.min(mask, where=mask > 0, initial=hi))
+        # labels lo..hi become 1..hi-lo+1 so that the bincounts only span the
+        # labels of this tile; background stays 0
+        local = mask.astype(np.intp) - (lo - 1)
+        local[mask == 0] = 0
+        local = local.ravel()
+        size = hi - lo + 2
+
+        self.counts = _grow(self.counts, hi + 1)
+        self.sums = _grow(self.sums, hi + 1)
+        self.bbox_min = _grow(self.bbox_min, hi + 1, np.iinfo(np.int64).max)
+        self.bbox_max = _grow(self.bbox_max, hi + 1)
+        self.counts[lo:hi+1] += np.bincount(local, minlength=size)[1:]
+
+        objects = scipy.ndimage.find_objects(local.reshape(mask.shape))
+        found = [ii for ii, oo in enumerate(objects) if oo is not None]
+        labels = np.array(found) + lo
+        for axis, offset in enumerate((y0, x0)):
+            starts = np.array([objects[ii][axis].start for ii in found]) + offset
+            stops = np.array([objects[ii][axis].stop for ii in found]) + offset
+            self.bbox_min[axis, labels] = np.minimum(self.bbox_min[axis, labels], starts)
+            self.bbox_max[axis, labels] = np.maximum(self.bbox_max[axis, labels], stops)
+        return local, lo, hi, size
+
+    def add_channel_tile(self, tile_index, channel, img):
+        local, lo, hi, size = tile_index
+        self.sums[channel, lo:hi+1] += np.bincount(
+            local, weights=img.ravel(), minlength=size
+        )[1:]
+
+    @property
+    def labels(self):
+        return np.nonzero(self.counts)[0]
+
+    @property
+    def max_extent(self):
+        labels = self.labels
+        if len(labels) == 0:
+            return 0
+        return int((self.bbox_max[:, labels] - self.bbox_min[:, labels]).max())
+
+    def mean_intensities(self):
+        labels = self.labels
+        return self.sums[:, labels] / self.counts[labels]
+
+
+def accumulate_intensities(img_reader, mask_readers, num_channels, tile_size):
+    """
+    Stream matching tiles of the masks and each image channel; each channel
+    tile is read once and added to the stats of every mask, and only one
+    tile per image is in memory at a time
+    """
+    all_stats = [LabelStats(num_channels) for _ in mask_readers]
+    height, width = img_reader.shape
+    for y0, x0 in tile_origins((height, width), tile_size):
+        y1, x1 = min(y0 + tile_size, height), min(x0 + tile_size, width)
+        tile_indices = [
+            (stats, stats.add_mask_tile(reader.read(0, y0, y1, x0, x1), y0, x0))
+            for stats, reader in zip(all_stats, mask_readers)
+        ]
+        tile_indices = [(ss, ii) for ss, ii in tile_indices if ii is not None]
+        if len(tile_indices) == 0:
+            continue
+        for channel in range(num_channels):
+            img = img_reader.read(channel, y0, y1, x0, x1)
+            for stats, tile_index in tile_indices:
+                stats.add_channel_tile(tile_index, channel, img)
+    return all_stats
+
+
+def measure_morphology(mask_reader, stats, tile_size):
+    """
+    Centroid and shape of each label with `skimage.measure.regionprops`;
+    a label is measured in the tile that contains the top-left corner of its
+    bounding box, read with a halo of the largest label extent so that the
+    label is whole
+    """
+    labels = stats.labels
+    columns = {
+        kk: np.zeros(len(labels))
+        for kk in ['X_centroid', 'Y_centroid', *MORPHOLOGY]
+    }
+    row_of = np.full(stats.counts.shape[0], -1, dtype=np.int64)
+    row_of[labels] = np.arange(len(labels))
+    halo = stats.max_extent
+    height, width = mask_reader.shape
+    tile_y = stats.bbox_min[0, labels] // tile_size
+    tile_x = stats.bbox_min[1, labels] // tile_size
+    for y0, x0 in tile_origins((height, width), tile_size):
+        owned = (tile_y == y0 // tile_size) & (tile_x == x0 // tile_size)
+        if not owned.any():
+            continue
+        y1 = min(y0 + tile_size + halo, height)
+        x1 = min(x0 + tile_size + halo, width)
+        mask = mask_reader.read(0, y0, y1, x0, x1)
+        owned_labels = set(labels[owned].tolist())
+        for region in skimage.measure.regionprops(mask):
+            if region.label not in owned_labels:
+                continue
+            row = row_of[region.label]
+            columns['Y_centroid'][row] = region.centroid[0] + y0
+            columns['X_centroid'][row] = region.centroid[1] + x0
+            for kk, vv in MORPHOLOGY.items():
+                columns[kk][row] = region[vv]
+    columns['Area'] = columns['Area'].astype(np.int64)
+    return columns
+
+
+def read_channel_names(channel_names_path):
+    """
+    Marker names from a one-column CSV without header or from the
+    `marker_name` column; repeated names get a _2, _3... suffix
+    """
+    markers = pd.read_csv(channel_names_path)
+    if markers.shape[1] > 1:
+        names = list(markers.marker_name)
+    else:
+        names = list(pd.read_csv(channel_names_path, header=None)[0])
+    return [
+        f"{nn}_{names[:ii].count(nn) + 1}" if names.count(nn) > 1 else nn
+        for ii, nn in enumerate(names)
+    ]
+
+
+def quantify(img_path, mask_paths, channel_names, tile_size=4096):
+    """
+    Single cell table of each label mask: mean intensity of each channel of
+    `img_path` in each label, centroid and shape, in the columns of
+    `CommandSingleCellExtraction.py`. The image is read once whatever the
+    number of masks. Memory is bounded by the tile size and the number of
+    labels, not by the image size
+    """
+    img_reader = TileReader(img_path)
+    mask_readers = []
+    try:
+        num_channels = len(img_reader.pages)
+        assert len(channel_names) == num_channels, (
+            f"{len(channel_names)} channel names for {num_channels} channels"
+        )
+        for mask_path in mask_paths:
+            mask_readers.append(TileReader(mask_path))
+            assert tuple(img_reader.shape) == tuple(mask_readers[-1].shape), (
+                f"{mask_path} {mask_readers[-1].shape} does not match"
+                f" {img_path} {img_reader.shape}"
+            )
+        all_stats = accumulate_intensities(
+            img_reader, mask_readers, num_channels, tile_size
+        )
+        morphologies = [
+            measure_morphology(reader, stats, tile_size)
+            for reader, stats in zip(mask_readers, all_stats)
+        ]
+    finally:
+        img_reader.close()
+        for reader in mask_readers:
+            reader.close()
+
+    return [
+        pd.concat([
+            pd.DataFrame({'CellID': stats.labels.astype(np.int32)}),
+            pd.DataFrame(dict(zip(channel_names, stats.mean_intensities()))),
+            pd.DataFrame(morphology),
+        ], axis=1)
+        for stats, morphology in zip(all_stats, morphologies)
+    ]
+
+
+def process_slide(img_path, mask_paths, channel_names_path, output_dir, tile_size=4096):
+    """Write `{image name}_{mask name}.csv` of each mask to `output_dir`"""
+    channel_names = read_channel_names(channel_names_path)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    img_name = pathlib.Path(img_path).name.split('.')[0]
+    start = time.perf_counter()
+    tables = quantify(img_path, mask_paths, channel_names, tile_size=tile_size)
+    output_paths = []
+    for mask_path, table in zip(mask_paths, tables):
+        mask_name = pathlib.Path(mask_path).name.split('.')[0]
+        output_path = output_dir / f"{img_name}_{mask_name}.csv"
+        table.to_csv(output_path, index=False)
+        output_paths.append(output_path)
+        print('Quantified', len(table), 'cells of', mask_name)
+    print(
+        f"{len(mask_paths)} masks quantified in"
+        f" {time.perf_counter() - start:.1f} s"
+    )
+    return output_paths
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description=(
+            'Tiled single cell quantification, writes the same tables as'
+            ' CommandSingleCellExtraction.py'
+        )
+    )
+    parser.add_argument('--masks', nargs='+', required=True)
+    parser.add_argument('--image', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--channel_names', required=True)
+    parser.add_argument('--tile-size', type=int, default=4096)
+    args = parser.parse_args(argv[1:])
+
+    process_slide(
+        args.image, args.masks, args.channel_names, args.output,
+        tile_size=args.tile_size
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
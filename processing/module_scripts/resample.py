@@ -0,0 +1,145 @@
+import fractions
+
+import dask.array as da
+import numpy as np
+
+
+def rational_scale(scale, max_denominator=4):
+    """`scale` as a fraction p/q with p, q <= `max_denominator`, or None"""
+    frac = fractions.Fraction(scale).limit_denominator(max_denominator)
+    if frac.numerator > max_denominator or abs(float(frac) - scale) > 1e-9:
+        return None
+    return frac
+
+
+def _upsample_linear_axis(block, factor, axis):
+    # `block` has a 1 pixel halo along `axis`, which is used up; pixel centers
+    # are aligned, i.e. output pixel i samples the input at
+    # (i + 0.5) / factor - 0.5
+    n = block.shape[axis] - 2
+
+    def take(start):
+        return block.take(np.arange(start, start + n), axis=axis)
+
+    left, center, right = take(0), take(1), take(2)
+    phases = []
+    for phase in range(factor):
+        d = np.float32((phase + 0.5) / factor - 0.5)
+        if d < 0:
+            phases.append(center + d * (center - left))
+        else:
+            phases.append(center + d * (right - center))
+    # interleave the phases along `axis`
+    out = np.stack(phases, axis=axis + 1 if axis >= 0 else axis)
+    shape = list(block.shape)
+    shape[axis] = n * factor
+    return out.reshape(shape)
+
+
+def _upsample_linear_block(block, factor):
+    block = block.astype(np.float32)
+    block = _upsample_linear_axis(block, factor, block.ndim - 2)
+    return _upsample_linear_axis(block, factor, block.ndim - 1)
+
+
+def upsample(img, factor, order=1):
+    """
+    Integer factor upsampling of the last two axes of a dask array; `order`
+    0 repeats pixels, 1 interpolates linearly between pixel centers
+    """
+    factor = int(factor)
+    if factor == 1:
+        return img
+    out_chunks = (
+        *img.chunks[:-2],
+        tuple(cc * factor for cc in img.chunks[-2]),
+        tuple(cc * factor for cc in img.chunks[-1]),
+    )
+    if order == 0:
+        return img.map_blocks(
+            lambda block: block.repeat(factor, axis=-2).repeat(factor, axis=-1),
+            chunks=out_chunks,
+            dtype=img.dtype
+        )
+    depth = {ii: 0 for ii in range(img.ndim - 2)}
+    depth.update({img.ndim - 2: 1, img.ndim - 1: 1})
+    overlapped = da.overlap.overlap(img, depth=depth, boundary='nearest')
+    return overlapped.map_blocks(
+        _upsample_linear_block, factor, chunks=out_chunks, dtype=np.float32
+    )
+
+
+def downsample(img, factor):
+    """Integer factor block-mean downsampling of the last two axes"""
+    factor = int(factor)
+    if factor == 1:
+        return img
+    H, W = img.shape[-2:]
+    pad_width = [(0, 0)] * (img.ndim - 2) + [
+        (0, -H % factor), (0, -W % factor)
+    ]
+    if any(pp[1] > 0 for pp in pad_width):
+        img = da.pad(img, pad_width, mode='edge')
+    # chunks must be multiples of the factor
+    chunk_size = max(max(img.chunksize[-2:]) // factor, 1) * factor
+    img = img.rechunk((*img.chunksize[:-2], chunk_size, chunk_size))
+    out_chunks = (
+        *img.chunks[:-2],
+        tuple(cc // factor for cc in img.chunks[-2]),
+        tuple(cc // factor for cc in img.chunks[-1]),
+    )
+    return img.map_blocks(
+        _block_mean, factor, chunks=out_chunks, dtype=np.float32
+    )
+
+
+def _block_mean(block, factor):
+    out = np.zeros(
+        (*block.shape[:-2], block.shape[-2] // factor, block.shape[-1] // factor),
+        dtype=np.float32
+    )
+    for yy in range(factor):
+        for xx in range(factor):
+            out += block[..., yy::factor, xx::factor]
+    out /= factor**2
+    return out
+
+
+def match_shape(img, shape):
+    """Crop or edge-pad the end of the last two axes so that they are `shape`"""
+    img = img[..., :shape[0], :shape[1]]
+    pad_width = [(0, 0)] * (img.ndim - 2) + [
+        (0, ss - ii) for ss, ii in zip(shape, img.shape[-2:])
+    ]
+    if any(pp[1] > 0 for pp in pad_width):
+        img = da.pad(img, pad_width, mode='edge')
+    return img
+
+
+def rescale(img, scale, output_shape, order=1, output_chunks=1024):
+    """
+    Resize the last two axes of dask array `img` by `scale` to `output_shape`.
+    Scales that are fractions of small integers use block-mean downsampling
+    and nearest (`order` 0) or linear (`order` 1) integer upsampling; other
+    scales fall back to `dask_image.ndinterp.affine_transform`. Integer
+    images keep their dtype
+    """
+    output_shape = tuple(int(ss) for ss in output_shape[-2:])
+    frac = rational_scale(scale)
+    if frac is None:
+        import dask_image.ndinterp
+
+        matrix = np.eye(img.ndim + 1)
+        matrix[-3, -3] = matrix[-2, -2] = 1 / scale
+        return dask_image.ndinterp.affine_transform(
+            img,
+            matrix=matrix,
+            order=order,
+            output_chunks=(*img.chunksize[:-2], output_chunks, output_chunks),
+            output_shape=(*img.shape[:-2], *output_shape)
+        )
+    out = downsample(upsample(img, frac.numerator, order=order), frac.denominator)
+    if np.issubdtype(img.dtype, np.integer) and (out.dtype != img.dtype):
+        out = out.round().astype(img.dtype)
+    out = match_shape(out, output_shape)
+    return out.rechunk((*img.chunksize[:-2], output_chunks, output_chunks))
@@ -0,0 +1,67 @@
+import numpy as np
+import scipy.ndimage
+import skimage.filters
+import skimage.morphology
+import tifffile
+
+from . import intensity
+
+
+def find_thumbnail_level(img_path, min_size=1024):
+    """Lowest resolution pyramid level whose longer side is at least `min_size`"""
+    with tifffile.TiffFile(img_path) as tif:
+        level_shapes = [ll.shape[-2:] for ll in tif.series[0].levels]
+    level = 0
+    for idx, shape in enumerate(level_shapes):
+        if max(shape) >= min_size:
+            level = idx
+    return level
+
+
+def tissue_mask(img_path, channel, min_size=1024, dilation_px=64):
+    """
+    Otsu threshold of `channel` at a low pyramid level, dilated by about
+    `dilation_px` full resolution pixels; returns the mask and the shape of the
+    full resolution image
+    """
+    full_shape = intensity.read_level(img_path, channel, level=0).shape
+    level = find_thumbnail_level(img_path, min_size=min_size)
+    thumbnail = np.asarray(intensity.read_level(img_path, channel, level=level))
+    if thumbnail.min() == thumbnail.max():
+        return np.zeros(thumbnail.shape, dtype=bool), full_shape
+    mask = thumbnail > skimage.filters.threshold_otsu(thumbnail)
+    radius = int(np.ceil(dilation_px * thumbnail.shape[0] / full_shape[0]))
+    if (radius <= 8) or not mask.any():
+        mask = scipy.ndimage.binary_dilation(
+            mask, structure=skimage.morphology.disk(radius)
+        )
+    else:
+        # same result, the time of a dilation grows with the disk area
+        mask = scipy.ndimage.distance_transform_edt(~mask) <= radius
+    return mask, full_shape
+
+
+def block_mask(mask, img_shape, chunks, margin=0):
+    """
+    Whether each block of a 2D image of `img_shape` split into dask `chunks`
+    overlaps `mask`, which covers the same field of view at any resolution;
+    blocks are extended by `margin` image pixels on each side
+    """
+    def mask_ranges(block_sizes, img_size, mask_size):
+        ends = np.cumsum(block_sizes)
+        starts = ends - block_sizes
+        scale = mask_size / img_size
+        return [
+            (
+                int(np.floor(max(ss - margin, 0) * scale)),
+                int(np.ceil(min(ee + margin, img_size) * scale))
+            )
+            for ss, ee in zip(starts, ends)
+        ]
+
+    row_ranges = mask_ranges(chunks[0], img_shape[0], mask.shape[0])
+    col_ranges = mask_ranges(chunks[1], img_shape[1], mask.shape[1])
+    return np.array([
+        [mask[r0:r1, c0:c1].any() for c0, c1 in col_ranges]
+        for r0, r1 in row_ranges
+    ])
@@ -7,79 +7,126 @@
 # python -m pip install scikit-image ipython matplotlib czifile nd2reader joblib tifffile zarr dask_image
 
 
+import atexit
+import contextlib
 import datetime
+import json
 import os
 import pathlib
 import sys
+import tempfile
 import time
 import warnings
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-import dask.array as da
-import dask.diagnostics
-import dask_image.ndinterp
+# TensorFlow, dask and zarr are imported where they are used so that
+# importing this module is cheap, see `get_engine` for the model
 import numpy as np
-import skimage.exposure
-import skimage.util
 import tifffile
-import zarr
 
 CURR = pathlib.Path(__file__).resolve().parent
 unmicst_path = CURR.parent.parent / 'modules' / 'UnMicst'
-sys.path.append(str(unmicst_path))
+model_path = unmicst_path / 'models' / 'nucleiDAPILAMIN'
 
-import UnMicst2 as UnMicst2
+# fastest inference batch size of each host and model, see `set_batch_size`
+BATCH_SIZE_CACHE = pathlib.Path.home() / '.cache' / 'orion-scripts' / 'inference_batch_size.json'
 
-from . import rowit
 
+def find_pyramid_level(img_path, scale):
+    """
+    Lowest resolution pyramid level of `img_path` that is not smaller than
+    the full resolution image scaled by `scale`; returns the level index and
+    its scale, which is `scale` itself when the level matches the scaled
+    shape within a pixel
+    """
+    with tifffile.TiffFile(img_path) as tif:
+        level_shapes = [ll.shape[-2:] for ll in tif.series[0].levels]
+    full_shape = np.array(level_shapes[0])
+    target_shape = np.ceil(scale * full_shape)
+    level, level_scale = 0, 1
+    for idx, shape in enumerate(level_shapes[1:], start=1):
+        if np.all(np.abs(np.array(shape) - target_shape) <= 1):
+            return idx, scale
+        shape_scale = np.min(np.divide(shape, full_shape))
+        if scale <= shape_scale < level_scale:
+            level, level_scale = idx, shape_scale
+    return level, level_scale
 
-def www4(img, border_size=24, out_dtype=None):
-    # return np.ones((*img.shape[:2], 3), np.float32)
-    assert img.ndim == 3
-    assert img.shape[0] in [1, 2, 3]
-    assert border_size >= 0
 
-    img = img[:2]
-    border_size = int(border_size)
-    C, Y, X = img.shape
-    
-    wv_cfg = rowit.WindowView((Y, X), 128, 2*border_size)
-    out_size = 128 - 2*border_size
-    wv_imgs = [
-        wv_cfg.window_view_list(channel)
-        for channel in img
-    ]
-    first_wv_img = wv_imgs[0]
-    n_patches = len(first_wv_img)
-    output = np.zeros((n_patches, out_size, out_size, 3), dtype=np.float32)
-
-    start = border_size if border_size > 0 else None
-    end = -border_size if border_size > 0 else None
-    for i in range(0, n_patches, 24):
-        batch = np.zeros((24, 128, 128, C))
-        n_sub_patches = len(first_wv_img[i:i+24])
-        for cc, wv_img in zip(range(C), wv_imgs):
-            batch[:n_sub_patches, ..., cc] = wv_img[i:i+24]
-        batch -= 0.18
-        batch /= 0.17
-        output[i:i+24] = UnMicst2.UNet2D.Session.run(
-            UnMicst2.UNet2D.nn,
-            feed_dict={UnMicst2.UNet2D.tfData: batch, UnMicst2.UNet2D.tfTraining: 0}
-        )[:n_sub_patches, start:end, start:end]
-    output = skimage.util.montage(
-        output,
-        grid_shape=wv_cfg.window_view_shape[:2],
-        channel_axis=3
-    )[:Y, :X]
-    if out_dtype is not None:
-        output = skimage.exposure.rescale_intensity(
-            output, in_range=(0, 1), out_range=out_dtype
-        ).astype(out_dtype)
-    return np.moveaxis(output, 2, 0)
+def choose_intermediate_store(shape, size_scaling_factor, ram_GB=None):
+    """
+    'memory' if the intermediates of a slide of `shape` fit in half of the
+    available RAM, 'fused' otherwise
+    """
+    import run_all_utils
+
+    H, W = shape
+    model_pixels = np.prod(np.ceil(size_scaling_factor * np.array([H, W])))
+    # float32 normalized image and 3-channel uint8 probability maps at model
+    # resolution, 3-channel uint8 probability maps at full resolution
+    needed_GB = (model_pixels * (4 + 3) + 3 * H * W) / 1024**3
+    if ram_GB is None:
+        ram_GB = run_all_utils.available_RAM_GB()
+    return 'memory' if needed_GB < 0.5 * ram_GB else 'fused'
+
+
+class IntermediateStores:
+    """
+    Where intermediates are computed to: 'memory' keeps them in in-memory
+    zarr arrays, 'disk' writes them to zarr arrays in a temporary directory
+    under `scratch_dir` and 'fused' does the same for the model resolution
+    intermediates but streams the full resolution probability maps straight
+    into the pyramid writer
+    """
+
+    def __init__(self, policy, scratch_dir=None):
+        assert policy in ('memory', 'disk', 'fused'), (
+            f"intermediate_store must be one of 'auto', 'memory', 'disk' or"
+            f" 'fused', not {policy!r}"
+        )
+        self.policy = policy
+        self.tmp_dir = None
+        if policy != 'memory':
+            if scratch_dir is not None:
+                scratch_dir = pathlib.Path(scratch_dir).expanduser()
+                scratch_dir.mkdir(exist_ok=True, parents=True)
+            self.tmp_dir = tempfile.TemporaryDirectory(
+                prefix='unmicst-', dir=scratch_dir
+            )
+        self.num_stores = 0
+
+    def to_zarr(self, da_img, **kwargs):
+        import zarr
+
+        zarr_store = None
+        if self.tmp_dir is not None:
+            self.num_stores += 1
+            zarr_store = zarr.open(
+                str(pathlib.Path(self.tmp_dir.name) / f"{self.num_stores}.zarr"),
+                mode='w',
+                shape=da_img.shape,
+                chunks=da_img.chunksize,
+                dtype=da_img.dtype
+            )
+        return da_to_zarr(da_img, zarr_store=zarr_store, **kwargs)
+
+    def cleanup(self):
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+
+
+def _phase(telemetry, name):
+    # `telemetry` is a `run_all_utils.Telemetry` or None
+    if telemetry is None:
+        return contextlib.nullcontext()
+    return telemetry.phase(name)
 
 
 def da_to_zarr(da_img, zarr_store=None, num_workers=None, out_shape=None, chunks=None):
+    import dask.diagnostics
+    import zarr
+
     if zarr_store is None:
         if out_shape is None:
             out_shape = da_img.shape
@@ -98,41 +145,157 @@ def da_to_zarr(da_img, zarr_store=None, num_workers=None, out_shape=None, chunks
     return zarr_store
 
 
-model_path = pathlib.Path(unmicst_path / 'models' / 'nucleiDAPILAMIN')
-with warnings.catch_warnings():
-    warnings.simplefilter('ignore')
-    UnMicst2.UNet2D.singleImageInferenceSetup(model_path, 0, -1, -1)
+_engine = None
 
 
-# 
-# Process input
-# 
-def process_slide(
+def get_engine():
+    """
+    The UnMicst model as an `inference.InferenceEngine`; the model is loaded
+    on the first call and reused afterwards
+    """
+    global _engine
+    if _engine is not None:
+        return _engine
+
+    from . import inference
+
+    if str(unmicst_path) not in sys.path:
+        sys.path.append(str(unmicst_path))
+    import UnMicst2 as UnMicst2
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        UnMicst2.UNet2D.singleImageInferenceSetup(model_path, 0, -1, -1)
+
+    def predict_batch(batch):
+        return UnMicst2.UNet2D.Session.run(
+            UnMicst2.UNet2D.nn,
+            feed_dict={UnMicst2.UNet2D.tfData: batch, UnMicst2.UNet2D.tfTraining: 0}
+        )
+
+    # the model takes the nucleus channel twice
+    _engine = inference.InferenceEngine(
+        predict_batch,
+        num_channels=2,
+        fixed_batch_size=UnMicst2.UNet2D.tfData.shape.as_list()[0] is not None
+    )
+    return _engine
+
+
+def _predict_block(
+    block, border_size=24, out_dtype=None, pool=None, tissue_blocks=None,
+    block_info=None
+):
+    # block is (1, Y, X), returns (3, Y, X); blocks without tissue are
+    # certain background: saturated background class, other classes 0
+    if tissue_blocks is not None:
+        _, yy, xx = block_info[0]['chunk-location']
+        if not tissue_blocks[yy, xx]:
+            import run_all_utils
+
+            dtype = np.dtype(out_dtype or np.float32)
+            output = np.zeros((3, *block.shape[1:]), dtype=dtype)
+            output[run_all_utils.PMAP_CLASSES['background']] = (
+                np.iinfo(dtype).max if dtype.kind in 'iu' else 1
+            )
+            return output
+    engine = get_engine()
+    if pool is not None:
+        return pool.predict(
+            engine, block[0], border_size=border_size, out_dtype=out_dtype
+        )
+    return engine.predict(block[0], border_size=border_size, out_dtype=out_dtype)
+
+
+def set_batch_size(engine, inference_batch_size=0):
+    """
+    Use `inference_batch_size` if > 0, otherwise the fastest size on this
+    host; it is measured once per host and model and cached in
+    `BATCH_SIZE_CACHE`, as each slide runs in a new process
+    """
+    import socket
+
+    if inference_batch_size > 0:
+        engine.batch_size = inference_batch_size
+        return
+    if engine.batch_size is not None:
+        return
+    key = '|'.join([
+        socket.gethostname(), str(model_path.resolve()), f"cpus={os.cpu_count()}",
+        f"gpus={os.environ.get('CUDA_VISIBLE_DEVICES')}"
+    ])
+    try:
+        with open(BATCH_SIZE_CACHE) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+    if isinstance(cache.get(key), int):
+        engine.batch_size = cache[key]
+        print('Inference batch size', engine.batch_size, 'from', BATCH_SIZE_CACHE)
+        return
+    engine.tune_batch_size()
+    cache[key] = engine.batch_size
+    try:
+        BATCH_SIZE_CACHE.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = BATCH_SIZE_CACHE.with_name(
+            f"{BATCH_SIZE_CACHE.name}.{os.getpid()}.tmp"
+        )
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2)
+        tmp_path.replace(BATCH_SIZE_CACHE)
+    except OSError as e:
+        print('Could not cache the inference batch size -', e)
+
+
+# worker processes are kept for the next slides of a stage worker and shut
+# down when this process exits
+_inference_pools = {}
+
+
+@atexit.register
+def _close_inference_pools():
+    for pool in _inference_pools.values():
+        pool.close()
+    _inference_pools.clear()
+
+
+def get_inference_pool(num_workers, intra_op_threads=0, inter_op_threads=0):
+    key = (num_workers, intra_op_threads, inter_op_threads)
+    if key not in _inference_pools:
+        from . import inference
+
+        _inference_pools[key] = inference.InferencePool(
+            __name__, num_workers,
+            intra_op_threads=intra_op_threads,
+            inter_op_threads=inter_op_threads
+        )
+    return _inference_pools[key]
+
+
+def read_model_image(
     img_path,
     nucleus_channel,
     size_scaling_factor=1,
-    intensity_in_range_p0=0,
-    intensity_in_range_p1=100,
-    intensity_min=None,
-    intensity_max=None,
-    # intensity_min=400,
-    # intensity_max=8000,
-    output_path=None,
-    intensity_gamma=0.8,
-    other_channels=None,
-    save_RAM=False
+    save_RAM=False,
+    use_pyramid_level=True
 ):
-    start = int(time.perf_counter())
+    """
+    Dask arrays of the nucleus channel at full resolution and resized to the
+    model resolution; the latter is read from the closest pyramid level
+    when `use_pyramid_level` instead of downsampling the full resolution
+    """
+    import dask.array as da
+    import zarr
 
-    img_path = pathlib.Path(img_path)
-    if output_path is None:
-        output_path = img_path.parent / f"{img_path.stem}-pmap.ome.tif"
-    else:
-        output_path = pathlib.Path(output_path)
-        out_name = output_path.name
-        assert out_name.endswith('.ome.tif') or out_name.endswith('.ome.tiff')
+    from . import intensity, resample
 
-    if save_RAM:
+    level, level_scale = 0, 1
+    if use_pyramid_level and size_scaling_factor < 1:
+        level, level_scale = find_pyramid_level(img_path, size_scaling_factor)
+
+    if save_RAM or level > 0:
+        # full resolution stays on disk, it is only read blockwise when
+        # intensity percentiles are computed from it
         img = zarr.open(tifffile.imread(
             img_path, key=nucleus_channel, aszarr=True
         ), mode='r')
@@ -140,40 +303,94 @@ def process_slide(
     else:
         img = tifffile.imread(img_path, key=nucleus_channel)
         da_img = da.from_array(img, chunks=2048)
+    model_img = da_img
+    if level > 0:
+        model_img = intensity.read_level(img_path, nucleus_channel, level)
+        if not save_RAM:
+            model_img = da.from_array(model_img.compute(), chunks=2048)
     print('Image shape:', da_img.shape)
-    H, W = da_img.shape
 
-    mx = np.eye(3) * size_scaling_factor
-    mx[-1, -1] = 1
-    out_shape = np.ceil(size_scaling_factor*np.array([H, W])).astype(int)
+    out_shape = np.ceil(size_scaling_factor*np.array(da_img.shape)).astype(int)
+    # resize to match model training input; block mean for integer and
+    # simple fractional scales, affine transform otherwise
+    residual_scale = size_scaling_factor / level_scale
+    if level > 0:
+        print(
+            f"Using pyramid level {level}, residual scaling factor"
+            f" {residual_scale:.3f}"
+        )
+    if residual_scale != 1:
+        model_img = resample.rescale(
+            model_img, residual_scale, out_shape, output_chunks=1024
+        )
+    elif level > 0:
+        model_img = resample.match_shape(
+            model_img, tuple(out_shape)
+        ).rechunk(1024)
+    return da_img, model_img
 
-    # resize to match model training input
-    transformed_img = da_img
-    if size_scaling_factor != 1:
-        transformed_img = dask_image.ndinterp.affine_transform(
-            da_img,
-            matrix=np.linalg.inv(mx),
-            output_chunks=(1024, 1024),
-            output_shape=out_shape
-        )
-    
-    # rescale intensity
+
+def intensity_in_range(percentile, p0=0, p1=100, vmin=None, vmax=None):
+    """
+    Intensity range mapped to the model input range; `vmin` and `vmax`
+    override the percentiles `p0` and `p1`, `percentile(q)` returns the
+    percentiles `q` of the image and is only called when one is None
+    """
     quantiles = []
     intensity_ps = []
-    if intensity_min is None:
-        quantiles.append(intensity_in_range_p0)
-    if intensity_max is None:
-        quantiles.append(intensity_in_range_p1)
+    if vmin is None:
+        quantiles.append(p0)
+    if vmax is None:
+        quantiles.append(p1)
     if len(quantiles) > 0:
-        intensity_ps = np.percentile(img, quantiles)
-    in_range = np.array(
-        [*intensity_ps, intensity_min, intensity_max],
-        dtype=float
-    )
-    in_range = np.sort(in_range)[:2]
-    print('\nin_range:', tuple(in_range), '\n')
-    transformed_img = (
-        transformed_img
+        intensity_ps = percentile(quantiles)
+    in_range = np.array([*intensity_ps, vmin, vmax], dtype=float)
+    return np.sort(in_range)[:2]
+
+
+def slide_histogram_key(img_path, nucleus_channel, percentile_level=0):
+    """
+    Description of the image and level a `slide_histogram` is computed from,
+    None for images without exact histograms (float or 32-bit)
+    """
+    from . import intensity
+
+    img_path = pathlib.Path(img_path)
+    img = intensity.read_level(img_path, nucleus_channel, level=percentile_level)
+    if not intensity.has_histogram(img.dtype):
+        return None
+    stat = img_path.stat()
+    return json.dumps(dict(
+        img_path=str(img_path.resolve()),
+        img_size=stat.st_size,
+        img_mtime=stat.st_mtime,
+        nucleus_channel=nucleus_channel,
+        shape=img.shape,
+    ))
+
+
+def slide_histogram(img_path, nucleus_channel, cache_path, percentile_level=0):
+    """
+    Intensity histogram (counts, offset) of the nucleus channel at
+    `percentile_level`, cached in `cache_path` and only computed again when
+    the image or the level changes; None for images without exact
+    histograms (float or 32-bit)
+    """
+    from . import intensity
+
+    key = slide_histogram_key(img_path, nucleus_channel, percentile_level)
+    if key is None:
+        return None
+    img = intensity.read_level(img_path, nucleus_channel, level=percentile_level)
+    return intensity.cached_histogram(img, cache_path, key)
+
+
+def normalize(img, in_range, gamma=0.8):
+    """Model input, `in_range` of dask array `img` to 0-0.95 with gamma"""
+    import skimage.exposure
+
+    img = (
+        img
         .map_blocks(
             skimage.exposure.rescale_intensity,
             in_range=tuple(in_range),
@@ -182,42 +399,272 @@ def process_slide(
         )
         .map_blocks(
             skimage.exposure.adjust_gamma,
-            gamma=intensity_gamma,
+            gamma=gamma,
             dtype=np.float32
         )
     )
-    transformed_img *= 0.95
+    return img * 0.95
+
+
+# pixels of context around each 1024x1024 inference block
+BLOCK_OVERLAP = 32
 
-    # compute once
-    zarr_transformed_img = da_to_zarr(transformed_img)
 
-    # model-ready image, rechunk into (3, TS, TS) seems to be needed
-    stack_img = da.array([da.from_zarr(zarr_transformed_img)]*3).rechunk(1024)
+def model_input(zarr_img):
+    """Normalized model resolution image as (1, 1024, 1024) blocks"""
+    import dask.array as da
 
-    prob_maps = stack_img.map_overlap(
-        www4,
+    return da.from_zarr(zarr_img)[np.newaxis].rechunk(1024)
+
+
+def predict_prob_maps(input_img, pool=None, tissue_blocks=None):
+    """
+    Dask array of the uint8 (3, Y, X) probability maps of `model_input`
+    blocks, each inferred with `BLOCK_OVERLAP` pixels of context
+    """
+    import dask.array as da
+
+    depth = {0: 0, 1: BLOCK_OVERLAP, 2: BLOCK_OVERLAP}
+    overlapped = da.overlap.overlap(input_img, depth=depth, boundary='none')
+    # the engine feeds the single channel to both model inputs and returns
+    # 3 channels per block
+    prob_maps = overlapped.map_blocks(
+        _predict_block,
         out_dtype=np.uint8,
-        depth={0:0, 1:32, 2:32},
-        boundary='none',
+        pool=pool,
+        tissue_blocks=tissue_blocks,
+        chunks=((3,), *overlapped.chunks[1:]),
         dtype=np.uint8
     )
+    return da.overlap.trim_internal(prob_maps, depth, boundary='none')
+
+
+# 
+# Process input
+# 
+def process_slide(
+    img_path,
+    nucleus_channel,
+    size_scaling_factor=1,
+    intensity_in_range_p0=0,
+    intensity_in_range_p1=100,
+    intensity_min=None,
+    intensity_max=None,
+    # intensity_min=400,
+    # intensity_max=8000,
+    output_path=None,
+    intensity_gamma=0.8,
+    other_channels=None,
+    save_RAM=False,
+    percentile_level=0,
+    use_pyramid_level=True,
+    intermediate_store='auto',
+    scratch_dir=None,
+    inference_batch_size=0,
+    inference_workers=1,
+    inference_intra_op_threads=0,
+    inference_inter_op_threads=0,
+    skip_background=False,
+    pmap_classes=None,
+    checkpoint=False,
+    histogram_path=None,
+    telemetry=None
+):
+    import dask.array as da
+    import run_all_utils
+
+    from . import checkpoint as checkpoint_store
+    from . import intensity, pyramid, resample, tissue
+
+    start = int(time.perf_counter())
 
-    zarr_prob_maps = da_to_zarr(
-        prob_maps,
-        num_workers=1
+    img_path = pathlib.Path(img_path)
+    if output_path is None:
+        output_path = img_path.parent / f"{img_path.stem}-pmap.ome.tif"
+    else:
+        output_path = pathlib.Path(output_path)
+        out_name = output_path.name
+        assert out_name.endswith('.ome.tif') or out_name.endswith('.ome.tiff')
+
+    with _phase(telemetry, 'read'):
+        da_img, model_img = read_model_image(
+            img_path,
+            nucleus_channel,
+            size_scaling_factor=size_scaling_factor,
+            save_RAM=save_RAM,
+            use_pyramid_level=use_pyramid_level
+        )
+    H, W = da_img.shape
+
+    if intermediate_store == 'auto':
+        intermediate_store = choose_intermediate_store(
+            (H, W), size_scaling_factor
+        )
+    print('Intermediate store:', intermediate_store)
+    # temporary directory is also removed when `stores` is garbage collected
+    stores = IntermediateStores(intermediate_store, scratch_dir=scratch_dir)
+
+    # rescale intensity; percentiles are histogram-based, exact for 8/16-bit
+    # images and computed blockwise so that `save_RAM` does not load the whole
+    # channel
+    percentile_img = da_img
+    if percentile_level > 0:
+        percentile_img = intensity.read_level(
+            img_path, nucleus_channel, level=percentile_level
+        )
+
+    def percentile(q):
+        # the histogram in `histogram_path` is reused by later runs
+        hist = None
+        if histogram_path is not None:
+            hist = slide_histogram(
+                img_path, nucleus_channel, histogram_path,
+                percentile_level=percentile_level
+            )
+        if hist is None:
+            return intensity.percentile(percentile_img, q)
+        counts, offset = hist
+        return intensity.percentile_from_histogram(counts, q, offset=offset)
+
+    with _phase(telemetry, 'intensity_range'):
+        in_range = intensity_in_range(
+            percentile,
+            p0=intensity_in_range_p0,
+            p1=intensity_in_range_p1,
+            vmin=intensity_min,
+            vmax=intensity_max
+        )
+    print('\nin_range:', tuple(in_range), '\n')
+    if telemetry is not None:
+        telemetry.record(in_range=in_range.tolist())
+    transformed_img = normalize(model_img, in_range, gamma=intensity_gamma)
+
+    # the normalized image and the model resolution probability maps are
+    # kept next to the output until the pyramid is written, so that a rerun
+    # with the same parameters only computes the missing chunks
+    checkpoint_dir = None
+    if checkpoint:
+        checkpoint_dir = checkpoint_store.Checkpoint(
+            output_path.parent / f"{output_path.name}.checkpoint",
+            key=dict(
+                img_path=str(img_path.resolve()),
+                img_size=img_path.stat().st_size,
+                img_mtime=img_path.stat().st_mtime,
+                nucleus_channel=nucleus_channel,
+                size_scaling_factor=size_scaling_factor,
+                use_pyramid_level=use_pyramid_level,
+                out_shape=transformed_img.shape,
+                in_range=in_range.tolist(),
+                intensity_gamma=intensity_gamma,
+                skip_background=skip_background,
+            )
+        )
+        print('Checkpoint:', checkpoint_dir.directory)
+
+    # compute once; resizing and intensity rescaling are computed together
+    with _phase(telemetry, 'resize_normalize'):
+        if checkpoint_dir is not None:
+            zarr_transformed_img = checkpoint_dir.to_zarr(
+                'normalized', transformed_img
+            )
+        else:
+            zarr_transformed_img = stores.to_zarr(transformed_img)
+
+    engine = get_engine()
+    set_batch_size(engine, inference_batch_size)
+    input_img = model_input(zarr_transformed_img)
+    # tiles are spread over worker processes, each running its own model
+    pool = None
+    if inference_workers > 1:
+        pool = get_inference_pool(
+            inference_workers,
+            intra_op_threads=inference_intra_op_threads,
+            inter_op_threads=inference_inter_op_threads
+        )
+    # blocks without tissue in a low resolution Otsu mask are not inferred
+    tissue_blocks = None
+    num_skipped = 0
+    if skip_background:
+        with _phase(telemetry, 'tissue_mask'):
+            mask, _ = tissue.tissue_mask(img_path, nucleus_channel)
+            tissue_blocks = tissue.block_mask(
+                mask, input_img.shape[1:], input_img.chunks[1:],
+                margin=BLOCK_OVERLAP
+            )
+        num_skipped = int((~tissue_blocks).sum())
+        print(
+            f"\nSkipping {num_skipped}/{tissue_blocks.size} blocks without"
+            f" tissue ({100 * num_skipped / tissue_blocks.size:.1f}%)"
+        )
+    prob_maps = predict_prob_maps(
+        input_img, pool=pool, tissue_blocks=tissue_blocks
     )
 
-    # final resizing
-    zarr_matched_prob_maps = zarr_prob_maps
+    engine.reset_stats()
+    inference_start = time.perf_counter()
+    with _phase(telemetry, 'inference'):
+        if checkpoint_dir is not None:
+            zarr_prob_maps = checkpoint_dir.to_zarr(
+                'prob_maps',
+                prob_maps,
+                num_workers=max(inference_workers, 1)
+            )
+        else:
+            zarr_prob_maps = stores.to_zarr(
+                prob_maps,
+                num_workers=max(inference_workers, 1)
+            )
+    inference_time = time.perf_counter() - inference_start
+    patches_per_s = engine.num_patches / inference_time
+    print(
+        f"\nInference: {engine.num_patches} patches, {patches_per_s:.1f}"
+        f" patches/s ({inference_workers} worker(s), batch size"
+        f" {engine.batch_size})"
+    )
+    # estimated from the time of the inferred blocks
+    num_blocks = np.prod(input_img.numblocks)
+    time_saved = 0
+    if num_skipped < num_blocks:
+        time_saved = num_skipped * inference_time / (num_blocks - num_skipped)
+    if num_skipped > 0:
+        print(f"Skipped blocks saved about {time_saved:.0f} s of inference")
+    if telemetry is not None:
+        telemetry.record(
+            inference_patches=engine.num_patches,
+            inference_patches_per_s=patches_per_s,
+            inference_batch_size=engine.batch_size,
+            inference_workers=inference_workers,
+            background_blocks_skipped=num_skipped,
+            blocks_total=int(num_blocks),
+            background_time_saved_s=time_saved
+        )
+
+    # final resizing, only of the kept classes
+    if pmap_classes is None:
+        pmap_classes = list(run_all_utils.PMAP_CLASSES)
+    pmap_classes = run_all_utils.parse_pmap_classes(pmap_classes)
+    class_indices = [run_all_utils.PMAP_CLASSES[cc] for cc in pmap_classes]
+    print('Probability map classes:', ', '.join(pmap_classes))
+    model_prob_maps = da.from_zarr(
+        zarr_prob_maps, chunks=(1, *zarr_prob_maps.chunks[1:])
+    )[class_indices]
+    matched_prob_maps = model_prob_maps
     if size_scaling_factor != 1:
-        matched_prob_maps = dask_image.ndinterp.affine_transform(
-            da.from_zarr(zarr_prob_maps, chunks=zarr_prob_maps.chunks),
-            matrix=np.roll(mx, 1, axis=(0, 1)),
-            output_chunks=(1, 2048, 2048),
-            output_shape=(3, H, W)
+        # linear interpolation between pixel centers for integer and simple
+        # fractional scales, affine transform otherwise
+        matched_prob_maps = resample.rescale(
+            model_prob_maps,
+            1 / size_scaling_factor,
+            (H, W),
+            output_chunks=2048
         )
 
-        zarr_matched_prob_maps = da_to_zarr(matched_prob_maps)
+        # with 'fused' the upsampling is computed by the pyramid writer
+        if stores.policy != 'fused':
+            with _phase(telemetry, 'upsample'):
+                matched_prob_maps = da.from_zarr(
+                    stores.to_zarr(matched_prob_maps)
+                )
 
     end = int(time.perf_counter())
     print('\nelapsed (unet):', datetime.timedelta(seconds=end - start))
@@ -225,16 +672,207 @@ def process_slide(
     import palom
 
     pixel_size = palom.reader.OmePyramidReader(img_path).pixel_size
-    palom.pyramid.write_pyramid(
-        [da.from_zarr(zarr_matched_prob_maps)[[2, 1, 0], ...]],
-        output_path,
-        pixel_size=pixel_size,
-        downscale_factor=2,
-        tile_size=1024,
-        compression='zlib',
-        save_RAM=True,
-        kwargs_tifffile=dict(software='unmicst v2.7.1')
+    # only level 0 needs the upsampled maps, the lower resolution levels are
+    # made from the model output
+    levels = pyramid.pyramid_levels(
+        matched_prob_maps,
+        sources=[(size_scaling_factor, model_prob_maps)],
+        downscale_factor=2
     )
+    with _phase(telemetry, 'pyramid_write'):
+        pyramid.write_pyramid(
+            levels,
+            output_path,
+            pixel_size=pixel_size,
+            tile_size=1024,
+            compression='zlib',
+            software='unmicst v2.7.1',
+            downscale_factor=2,
+            channel_names=pmap_classes
+        )
+    stores.cleanup()
+    if checkpoint_dir is not None:
+        checkpoint_dir.remove()
 
     end = int(time.perf_counter())
     print('\nelapsed (total):', datetime.timedelta(seconds=end - start))
+
+
+# normalization parameters that `sweep` varies
+SWEEP_PARAMS = (
+    'intensity_in_range_p0',
+    'intensity_in_range_p1',
+    'intensity_min',
+    'intensity_max',
+    'intensity_gamma',
+)
+
+
+def sweep(
+    img_path,
+    nucleus_channel,
+    param_sets,
+    output_dir,
+    name=None,
+    roi=None,
+    size_scaling_factor=1,
+    save_RAM=False,
+    percentile_level=0,
+    use_pyramid_level=True,
+    inference_batch_size=0,
+    pmap_classes=None,
+):
+    """
+    Probability maps of one slide for each of `param_sets`, dicts of
+    `SWEEP_PARAMS` values. The nucleus channel is read and resized once and
+    only the normalization and inference are run per parameter set; `roi`
+    (y, x, height, width in full resolution pixels) limits the maps to a
+    region, aligned to the model resolution pixels. Percentiles are always
+    of the whole slide so that the settings carry over to `process_slide`.
+    Writes <name>-sweep-<i>.ome.tif and <name>-sweep.csv, with the
+    parameters and timings, to `output_dir`; returns the rows of the csv
+    """
+    import csv
+
+    import dask.array as da
+    import palom
+    import run_all_utils
+
+    from . import intensity, pyramid, resample
+
+    assert len(param_sets) > 0, 'no parameter sets to sweep'
+    img_path = pathlib.Path(img_path)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(exist_ok=True, parents=True)
+    if name is None:
+        name = img_path.stem
+
+    start = time.perf_counter()
+    da_img, model_img = read_model_image(
+        img_path,
+        nucleus_channel,
+        size_scaling_factor=size_scaling_factor,
+        save_RAM=save_RAM,
+        use_pyramid_level=use_pyramid_level
+    )
+    H, W = da_img.shape
+    if roi is None:
+        roi = (0, 0, H, W)
+    y, x, h, w = roi
+    my0 = int(np.floor(y * size_scaling_factor))
+    mx0 = int(np.floor(x * size_scaling_factor))
+    my1 = min(int(np.ceil((y + h) * size_scaling_factor)), model_img.shape[0])
+    mx1 = min(int(np.ceil((x + w) * size_scaling_factor)), model_img.shape[1])
+    assert (my1 > my0) and (mx1 > mx0), f"empty region of interest {roi}"
+    # the resized region is computed once and reused by all parameter sets
+    cached_img = da.from_zarr(da_to_zarr(
+        model_img[my0:my1, mx0:mx1].rechunk(1024)
+    ))
+    roi_shape = np.round(
+        np.divide(cached_img.shape, size_scaling_factor)
+    ).astype(int)
+    read_time = time.perf_counter() - start
+    print(
+        f"\nRegion {tuple(roi)}, {cached_img.shape} at model resolution, read"
+        f" and resized in {read_time:.1f} s"
+    )
+
+    percentile_img = da_img
+    if percentile_level > 0:
+        percentile_img = intensity.read_level(
+            img_path, nucleus_channel, level=percentile_level
+        )
+    percentile = intensity.percentile_function(percentile_img)
+
+    engine = get_engine()
+    set_batch_size(engine, inference_batch_size)
+
+    if pmap_classes is None:
+        pmap_classes = list(run_all_utils.PMAP_CLASSES)
+    pmap_classes = run_all_utils.parse_pmap_classes(pmap_classes)
+    class_indices = [run_all_utils.PMAP_CLASSES[cc] for cc in pmap_classes]
+    pixel_size = palom.reader.OmePyramidReader(img_path).pixel_size
+
+    rows = []
+    for idx, params in enumerate(param_sets):
+        print(f"\nParameter set {idx}:", params)
+        t0 = time.perf_counter()
+        in_range = intensity_in_range(
+            percentile,
+            p0=params.get('intensity_in_range_p0', 0),
+            p1=params.get('intensity_in_range_p1', 100),
+            vmin=params.get('intensity_min'),
+            vmax=params.get('intensity_max')
+        )
+        print('in_range:', in_range.tolist())
+        t1 = time.perf_counter()
+        zarr_img = da_to_zarr(normalize(
+            cached_img, in_range, gamma=params.get('intensity_gamma', 0.8)
+        ))
+        t2 = time.perf_counter()
+        engine.reset_stats()
+        zarr_prob_maps = da_to_zarr(predict_prob_maps(model_input(zarr_img)))
+        t3 = time.perf_counter()
+
+        model_prob_maps = da.from_zarr(
+            zarr_prob_maps, chunks=(1, *zarr_prob_maps.chunks[1:])
+        )[class_indices]
+        matched_prob_maps = model_prob_maps
+        if size_scaling_factor != 1:
+            matched_prob_maps = resample.rescale(
+                model_prob_maps,
+                1 / size_scaling_factor,
+                roi_shape,
+                output_chunks=2048
+            )
+        levels = pyramid.pyramid_levels(
+            matched_prob_maps,
+            sources=[(size_scaling_factor, model_prob_maps)],
+            downscale_factor=2
+        )
+        output_path = output_dir / f"{name}-sweep-{idx}.ome.tif"
+        pyramid.write_pyramid(
+            levels,
+            output_path,
+            pixel_size=pixel_size,
+            tile_size=1024,
+            compression='zlib',
+            software='unmicst v2.7.1',
+            downscale_factor=2,
+            channel_names=pmap_classes
+        )
+        t4 = time.perf_counter()
+        rows.append({
+            'parameter_set': idx,
+            **{kk: params.get(kk) for kk in SWEEP_PARAMS},
+            'in_range_min': in_range[0],
+            'in_range_max': in_range[1],
+            'percentile_s': round(t1 - t0, 2),
+            'normalize_s': round(t2 - t1, 2),
+            'inference_s': round(t3 - t2, 2),
+            'patches_per_s': round(engine.patches_per_s, 1),
+            'write_s': round(t4 - t3, 2),
+            'output': output_path.name,
+        })
+
+    summary_path = output_dir / f"{name}-sweep.csv"
+    with open(summary_path, 'w', newline='') as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    columns = [
+        'parameter_set', *SWEEP_PARAMS, 'percentile_s', 'normalize_s',
+        'inference_s', 'write_s'
+    ]
+    print(f"\nRead and resize (once): {read_time:.1f} s")
+    print('  '.join(columns))
+    for row in rows:
+        print('  '.join(
+            f"{'' if row[cc] is None else row[cc]!s:>{len(cc)}}" for cc in columns
+        ))
+    print('\nelapsed (sweep):', datetime.timedelta(
+        seconds=int(time.perf_counter() - start)
+    ))
+    print('Summary:', summary_path)
+    return rows
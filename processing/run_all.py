@@ -1,13 +1,74 @@
 import sys
+import hashlib
 import pathlib
 import subprocess
 import argparse
 import configparser
+import tempfile
+
+import run_all_utils
 
 
 FLOW = ('unmicst', 's3seg', 'quantification')
 
 
+def setup_distributed(
+    pipeline, file_config, parsed_args, custom_config_path,
+    lease_timeout, status_dir=None
+):
+    # nodes running the same csv and ini files share the "done" records;
+    # forced runs keep separate records from the regular ones
+    run_key = hashlib.sha1()
+    for path in (parsed_args.c, custom_config_path):
+        if pathlib.Path(path).is_file():
+            run_key.update(pathlib.Path(path).read_bytes())
+    run_key.update(f"force={parsed_args.force}".encode())
+    run_key = run_key.hexdigest()
+
+    if parsed_args.force:
+        # otherwise the records of a previous forced run would skip every step
+        for config in file_config:
+            for step in pipeline.steps:
+                run_all_utils.StepLease(
+                    config['out_dir'], config['name'], step
+                ).clear_done()
+
+    leases = {}
+
+    def claim_step(step, slide_idx):
+        config = file_config[slide_idx]
+        lease = run_all_utils.StepLease(
+            config['out_dir'], config['name'], step, timeout=lease_timeout
+        )
+        if lease.is_done(run_key):
+            return 'done'
+        if not lease.acquire():
+            return 'wait'
+        # another node may have finished it just before the lease was taken
+        if lease.is_done(run_key):
+            lease.release()
+            return 'done'
+        leases[(step, slide_idx)] = lease
+        return 'run'
+
+    def release_step(step, slide_idx, returncode):
+        lease = leases.pop((step, slide_idx))
+        lease.release(done=returncode == 0, run_key=run_key)
+
+    pipeline.claim_step = claim_step
+    pipeline.release_step = release_step
+    pipeline.retry_interval = min(60, lease_timeout / 4)
+
+    if status_dir is None:
+        csv_path = pathlib.Path(parsed_args.c)
+        status_dir = csv_path.parent / f"{csv_path.stem}-status"
+    node_status = run_all_utils.NodeStatus(
+        pathlib.Path(status_dir).expanduser(), pipeline.names
+    )
+    pipeline.on_report = node_status.update
+    print(f"Distributed mode, writing progress to {node_status.path}", flush=True)
+
+
 def main(argv=sys.argv):
     
     CURR = pathlib.Path(__file__).resolve().parent
@@ -24,6 +85,21 @@ def main(argv=sys.argv):
         required=False,
         default=None
     )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='rerun slides even if the outputs are up to date'
+    )
+    parser.add_argument(
+        '--distributed',
+        action='store_true',
+        help=(
+            'share the slides with other machines running the same command'
+            ' on the same files, through lease files next to the outputs;'
+            ' with --force, a machine started late also reruns the steps'
+            ' other machines already finished'
+        )
+    )
     parsed_args = parser.parse_args(argv[1:])
 
     init_config = configparser.ConfigParser(allow_no_value=True)
@@ -74,16 +150,121 @@ def main(argv=sys.argv):
         for step in STEPS
     ]
 
-    for step, env_path, script_path in zip(STEPS, env_paths, script_paths):
-        subprocess.run([
-            'conda', 'run', '--no-capture-output',
-            '-p', str(env_path),
-            'python', str(script_path),
-            '-c', parsed_args.c,
-            '-m', custom_config_path
-        ])
+    def get_option(section, key, fallback=None, convert=str):
+        # custom config first, then the default run_all.ini
+        for config in (custom_config, init_config):
+            if config.has_option(section, key):
+                value = config.get(section, key)
+                if value in (None, ''):
+                    return fallback
+                return convert(value)
+        return fallback
 
-    return 0
+    def to_bool(value):
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+    max_jobs = {
+        step: get_option('Processes', f"{step}-max-jobs", None, int)
+        for step in STEPS
+    }
+    step_cpus = {
+        step: get_option('Processes', f"{step}-cpus", 1, int)
+        for step in STEPS
+    }
+    budget = run_all_utils.ResourceBudget(
+        ram_GB=get_option('Processes', 'ram-budget-GB', None, float),
+        cpus=get_option('Processes', 'cpu-budget', None, int)
+    )
+    print(
+        f"Resource budget: {budget.ram_GB:.1f} GB RAM, {budget.cpus} CPUs",
+        flush=True
+    )
+
+    persistent_workers = get_option(
+        'Processes', 'persistent-workers', False, to_bool
+    )
+
+    file_config = [
+        run_all_utils.set_config_defaults(config)
+        for config in run_all_utils.process_arg_path(parsed_args.c)
+    ]
+    step_envs = dict(zip(STEPS, env_paths))
+    step_scripts = dict(zip(STEPS, script_paths))
+
+    with tempfile.TemporaryDirectory(prefix='orion-run-all-') as tmp_dir:
+        # each slide is passed to the step scripts as a single-row csv
+        slide_csvs = [
+            run_all_utils.write_slide_csv(
+                config, pathlib.Path(tmp_dir) / f"{idx:04}.csv"
+            )
+            for idx, config in enumerate(file_config)
+        ]
+
+        def step_args(slide_idx):
+            return [
+                '-c', str(slide_csvs[slide_idx]),
+                '-m', str(custom_config_path),
+                *(['--force'] if parsed_args.force else [])
+            ]
+
+        worker_pool = None
+        if persistent_workers:
+            worker_pool = run_all_utils.StageWorkerPool(step_envs)
+
+        def run_step(step, slide_idx):
+            if worker_pool is not None:
+                return worker_pool.run(step, step_args(slide_idx))
+            return subprocess.run([
+                'conda', 'run', '--no-capture-output',
+                '-p', str(step_envs[step]),
+                'python', str(step_scripts[step]),
+                *step_args(slide_idx)
+            ]).returncode
+
+        def job_resources(step, slide_idx):
+            config = file_config[slide_idx]
+            module_params = {}
+            pmap_path = None
+            if step == 'unmicst':
+                module_params['size_scaling_factor'] = get_option(
+                    'unmicst', 'size_scaling_factor', 0.5, float
+                )
+            if step == 's3seg':
+                name = config['name']
+                channel = get_option('s3seg', 'probMapChan', 1, int) - 1
+                pmap_path = (
+                    config['out_dir'] / name / 'unmicst2'
+                    / f"{name}_Probabilities_{channel}.ome.tif"
+                )
+            if step == 'quantification':
+                module_params['num_masks'] = len(get_option(
+                    'quantification', 'masks name pattern', '*cellRing*.ome.tif'
+                ).split(','))
+                module_params['engine'] = get_option(
+                    'quantification', 'engine', 'mcmicro'
+                )
+            ram_GB = run_all_utils.estimate_RAM_usage(
+                step, config['path'], module_params, pmap_path=pmap_path
+            )
+            return ram_GB, step_cpus[step]
+
+        pipeline = run_all_utils.SlidePipeline(
+            STEPS, [config['name'] for config in file_config], run_step,
+            max_jobs=max_jobs, budget=budget, job_resources=job_resources
+        )
+        if parsed_args.distributed:
+            setup_distributed(
+                pipeline, file_config, parsed_args, custom_config_path,
+                lease_timeout=60 * get_option(
+                    'Processes', 'lease-timeout-minutes', 10, float
+                ),
+                status_dir=get_option('Processes', 'status-dir', None)
+            )
+        try:
+            return pipeline.run()
+        finally:
+            if worker_pool is not None:
+                worker_pool.close()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,16 @@
 import configparser
+import contextlib
 import csv
 import datetime
+import json
+import os
 import pathlib
+import queue
+import struct
+import subprocess
+import sys
+import threading
+import time
 
 
 def process_arg_path(path):
@@ -38,16 +47,513 @@ def set_config_defaults(config):
     }
 
 
-def to_log(log_path, img_path, time_diff, kwargs):
-    import tifffile
-    img_path = pathlib.Path(img_path)
-    with tifffile.TiffFile(img_path) as tif:
-        shape = tif.series[0].shape
-    arg_str = ', '.join([f"{k}={v}" for k, v in kwargs.items()])
-    with open(log_path, 'a') as log_file:
-        log_file.write(
-            f"{datetime.timedelta(seconds=time_diff)} | {img_path.name} | {shape} | {arg_str}\n"
+_TIFF_DTYPES = {
+    (1, 8): 'uint8', (1, 16): 'uint16', (1, 32): 'uint32',
+    (2, 8): 'int8', (2, 16): 'int16', (2, 32): 'int32',
+    (3, 32): 'float32', (3, 64): 'float64',
+}
+
+
+def read_ome_tiff_info(img_path):
+    """
+    Read image shape (C, Y, X), dtype, channel names and the OME-XML from the
+    header of an (OME-)TIFF using only the standard library, so that it can be
+    used outside of the processing conda envs
+    """
+    import re
+
+    with open(img_path, 'rb') as f:
+        byteorder = {b'II': '<', b'MM': '>'}[f.read(2)]
+        version, = struct.unpack(f"{byteorder}H", f.read(2))
+        if version == 43:
+            _, _, ifd_offset = struct.unpack(f"{byteorder}HHQ", f.read(12))
+            count_fmt, entry_fmt, value_size = 'Q', 'HHQ', 8
+        else:
+            ifd_offset, = struct.unpack(f"{byteorder}I", f.read(4))
+            count_fmt, entry_fmt, value_size = 'H', 'HHI', 4
+        f.seek(ifd_offset)
+        num_tags, = struct.unpack(
+            f"{byteorder}{count_fmt}",
+            f.read(struct.calcsize(count_fmt))
+        )
+        entry_size = struct.calcsize(f"{byteorder}{entry_fmt}") + value_size
+        tags = {}
+        for _ in range(num_tags):
+            entry = f.read(entry_size)
+            tag, dtype, count = struct.unpack(
+                f"{byteorder}{entry_fmt}", entry[:-value_size]
+            )
+            tags[tag] = (dtype, count, entry[-value_size:])
+
+        def tag_value(tag, default=None):
+            if tag not in tags:
+                return default
+            dtype, count, value = tags[tag]
+            if dtype == 2:
+                if count > value_size:
+                    offset, = struct.unpack(
+                        f"{byteorder}{'Q' if value_size == 8 else 'I'}", value
+                    )
+                    f.seek(offset)
+                    value = f.read(count)
+                return value[:count].rstrip(b'\x00').decode('utf-8', 'replace')
+            fmt = {3: 'H', 4: 'I', 16: 'Q'}[dtype]
+            return struct.unpack_from(f"{byteorder}{fmt}", value)[0]
+
+        description = tag_value(270, '')
+        width, height = tag_value(256), tag_value(257)
+        bits, sample_format = tag_value(258, 8), tag_value(339, 1)
+
+    info = {
+        'shape': (1, height, width),
+        'dtype': _TIFF_DTYPES.get((sample_format, bits), f"uint{bits}"),
+        'channel_names': [],
+        'ome_xml': None
+    }
+    pixels = re.search(r'<(?:\w+:)?Pixels\s[^>]*>', description)
+    if pixels is not None:
+        attrs = dict(re.findall(r'(\w+)="([^"]*)"', pixels.group(0)))
+        info['shape'] = (
+            int(attrs.get('SizeC', 1)),
+            int(attrs.get('SizeY', height)),
+            int(attrs.get('SizeX', width))
+        )
+        ome_type = attrs.get('Type', info['dtype'])
+        info['dtype'] = {'float': 'float32', 'double': 'float64'}.get(
+            ome_type, ome_type
+        )
+        info['channel_names'] = [
+            cc.group(1) for cc in
+            re.finditer(r'<(?:\w+:)?Channel\s[^>]*?\bName="([^"]*)"', description)
+        ]
+        info['ome_xml'] = description
+    return info
+
+
+# probability maps written by the unmicst step, in the order of the channels
+# of the output, and their class index in the UnMicst model output
+PMAP_CLASSES = {'nuclei': 2, 'contours': 1, 'background': 0}
+
+
+def parse_pmap_classes(pmap_classes):
+    """
+    Class names from a comma-separated string or a list, sorted in the order
+    of `PMAP_CLASSES` whatever the given order is; nuclei, when kept, is
+    always the first channel
+    """
+    if isinstance(pmap_classes, str):
+        pmap_classes = pmap_classes.split(',')
+    names = {cc.strip().lower() for cc in pmap_classes if cc.strip()}
+    if len(names) == 0:
+        raise ValueError(
+            f"no probability map classes given, must be some of"
+            f" {list(PMAP_CLASSES)}"
+        )
+    unknown = names - set(PMAP_CLASSES)
+    if unknown:
+        raise ValueError(
+            f"unknown probability map classes {sorted(unknown)}, must be some"
+            f" of {list(PMAP_CLASSES)}"
+        )
+    return [cc for cc in PMAP_CLASSES if cc in names]
+
+
+def estimate_RAM_usage(step, img_path, module_params, pmap_path=None):
+    """
+    Rough peak RAM (GB) of processing one slide in `step`, based on the image
+    shape, dtype and the module parameters
+    """
+    info = read_ome_tiff_info(img_path)
+    num_channels, height, width = info['shape']
+    itemsize = int(''.join(filter(str.isdigit, info['dtype'])) or 8) // 8
+    num_pixels = height * width / 1024**3
+
+    if step == 'unmicst':
+        factor = module_params.get('size_scaling_factor', 1)
+        # nucleus channel; normalized float32 image and 3-class uint8 pmap at
+        # model resolution; 3-class uint8 pmap at full resolution
+        return num_pixels * (itemsize + factor**2 * (4 + 3) + 3 + 1) + 2
+    if step == 's3seg':
+        num_pmap_channels = 1
+        if pmap_path is not None and pathlib.Path(pmap_path).exists():
+            num_pmap_channels = read_ome_tiff_info(pmap_path)['shape'][0]
+        # nucleus channel, pmaps and several int32 label images
+        return num_pixels * (itemsize + num_pmap_channels + 4 * 4) + 1
+    if step == 'quantification':
+        num_masks = module_params.get('num_masks', 1)
+        if module_params.get('engine') == 'tiled':
+            # 4096x4096 tiles of each mask, their bincount indices and a
+            # channel; float64 sums of each channel per cell of each mask,
+            # taking a cell per 200 pixels
+            num_cells = num_pixels * 1024**3 / 200
+            return 0.25 + num_masks * (
+                0.25 + num_cells * (num_channels + 6) * 8 / 1024**3
+            )
+        return (1 + 2 + 4 * num_masks) * num_pixels
+    raise ValueError(f"no memory model for {step}")
+
+
+def available_RAM_GB():
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024**3
+    except ImportError:
+        pass
+    try:
+        return (
+            os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024**3
+        )
+    except (AttributeError, ValueError, OSError):
+        raise RuntimeError(
+            'cannot determine available RAM, install psutil or set'
+            ' ram-budget-GB in [Processes]'
+        )
+
+
+class ResourceBudget:
+    """
+    Admit jobs while their total estimated RAM (GB) and number of CPUs fit in
+    the budget. A job larger than the whole budget runs alone
+    """
+
+    def __init__(self, ram_GB=None, cpus=None):
+        if ram_GB is None:
+            ram_GB = available_RAM_GB()
+        if cpus is None:
+            cpus = os.cpu_count()
+        self.ram_GB = ram_GB
+        self.cpus = cpus
+        self.used_ram_GB = 0
+        self.used_cpus = 0
+        self.num_running = 0
+        self._lock = threading.Condition()
+
+    def _fits(self, ram_GB, cpus):
+        if self.num_running == 0:
+            return True
+        return (
+            (self.used_ram_GB + ram_GB <= self.ram_GB)
+            and (self.used_cpus + cpus <= self.cpus)
+        )
+
+    def acquire(self, ram_GB, cpus=1):
+        with self._lock:
+            while not self._fits(ram_GB, cpus):
+                self._lock.wait()
+            self.used_ram_GB += ram_GB
+            self.used_cpus += cpus
+            self.num_running += 1
+
+    def release(self, ram_GB, cpus=1):
+        with self._lock:
+            self.used_ram_GB -= ram_GB
+            self.used_cpus -= cpus
+            self.num_running -= 1
+            self._lock.notify_all()
+
+
+def _cpu_time():
+    # children are counted once they have been waited for
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _io_chars():
+    """
+    Bytes read and written by this process; on linux this includes the
+    children it has waited for
+    """
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (ImportError, AttributeError, OSError):
+        return None
+
+
+def _children_io_chars():
+    """
+    {pid: (bytes read, bytes written)} of the running descendants, which are
+    not yet counted by `_io_chars`; empty without psutil
+    """
+    try:
+        import psutil
+    except ImportError:
+        return {}
+    counters = {}
+    try:
+        children = psutil.Process().children(recursive=True)
+    except psutil.Error:
+        return {}
+    for child in children:
+        try:
+            io = child.io_counters()
+        except (psutil.Error, AttributeError):
+            continue
+        counters[child.pid] = (
+            getattr(io, 'read_chars', io.read_bytes),
+            getattr(io, 'write_chars', io.write_bytes)
         )
+    return counters
+
+
+def _children_peak_rss_MB():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    unit = 1024**2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+
+
+def _reset_peak_rss():
+    # linux only, so that a long-lived process reports the peak of each job
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_MB(include_children=True):
+    """
+    Peak RSS of this process and of the largest waited-for child; the child
+    peak is over the lifetime of this process and cannot be reset
+    """
+    peak_self = None
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    peak_self = int(line.split()[1]) / 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024**2
+    # bytes on macOS, kilobytes on linux
+    unit = 1024**2 if sys.platform == 'darwin' else 1024
+    if peak_self is None:
+        peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    if not include_children:
+        return peak_self
+    return max(peak_self, _children_peak_rss_MB())
+
+
+class Telemetry:
+    """
+    Sub-phase timings and resource usage of processing one slide in one
+    step, written as one JSON line by `to_log`
+    """
+
+    def __init__(self, step, name, img_path):
+        self.step = step
+        self.name = name
+        self.img_path = pathlib.Path(img_path)
+        self.phases = {}
+        self.extra = {}
+        _reset_peak_rss()
+        # in a reused process (loky or stage worker) the children peak may
+        # come from a previous slide and is then left out
+        self._count_children_rss = _children_peak_rss_MB() == 0
+        self._start_io = _io_chars()
+        self._start_children_io = _children_io_chars()
+        self._start_cpu = _cpu_time()
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (
+                self.phases.get(name, 0) + time.perf_counter() - start
+            )
+
+    def record(self, **kwargs):
+        self.extra.update(kwargs)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def to_record(self, module_params, input_paths=(), output_paths=()):
+        import socket
+
+        io_chars = _io_chars()
+        bytes_read = bytes_written = None
+        if (io_chars is not None) and (self._start_io is not None):
+            bytes_read = io_chars[0] - self._start_io[0]
+            bytes_written = io_chars[1] - self._start_io[1]
+            # children still running, e.g. pool workers
+            for pid, (rr, ww) in _children_io_chars().items():
+                start_rr, start_ww = self._start_children_io.get(pid, (0, 0))
+                bytes_read += rr - start_rr
+                bytes_written += ww - start_ww
+        try:
+            shape = read_ome_tiff_info(self.img_path)['shape']
+        except (OSError, KeyError, struct.error):
+            shape = None
+        return {
+            'time': datetime.datetime.now().isoformat(),
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'step': self.step,
+            'name': self.name,
+            'image': str(self.img_path),
+            'shape': shape,
+            'elapsed_s': self.elapsed,
+            'cpu_time_s': _cpu_time() - self._start_cpu,
+            'peak_rss_MB': peak_rss_MB(
+                include_children=self._count_children_rss
+            ),
+            'bytes_read': bytes_read,
+            'bytes_written': bytes_written,
+            'input_bytes': sum(
+                pathlib.Path(pp).stat().st_size for pp in input_paths
+                if pathlib.Path(pp).exists()
+            ),
+            'output_bytes': sum(
+                pathlib.Path(pp).stat().st_size for pp in output_paths
+                if pathlib.Path(pp).exists()
+            ),
+            'phases_s': self.phases,
+            **self.extra,
+            'params': _normalize_params(module_params),
+        }
+
+
+def _lock_file(file, lock=True):
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        file.seek(0)
+        msvcrt.locking(
+            file.fileno(), msvcrt.LK_LOCK if lock else msvcrt.LK_UNLCK, 1
+        )
+        return
+    fcntl.flock(file, fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+    """Exclusive lock between processes on `lock_path`, held in the context"""
+    with open(lock_path, 'a') as lock_file:
+        _lock_file(lock_file)
+        try:
+            yield
+        finally:
+            _lock_file(lock_file, lock=False)
+
+
+def append_jsonl(path, record):
+    """Append one JSON line; safe with several processes appending at once"""
+    line = json.dumps(record, default=str) + '\n'
+    with open(path, 'a') as log_file:
+        _lock_file(log_file)
+        try:
+            log_file.write(line)
+            log_file.flush()
+        finally:
+            _lock_file(log_file, lock=False)
+
+
+def to_log(log_path, telemetry, kwargs, input_paths=(), output_paths=()):
+    append_jsonl(
+        log_path,
+        telemetry.to_record(
+            kwargs, input_paths=input_paths, output_paths=output_paths
+        )
+    )
+
+
+def file_identity(path):
+    path = pathlib.Path(path)
+    stat = path.stat()
+    return {
+        'path': str(path.resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns
+    }
+
+
+def manifest_path(out_dir, name, module_name):
+    return pathlib.Path(out_dir) / name / '.manifest' / f"{module_name}.json"
+
+
+def _normalize_params(module_params):
+    # round trip through json so that e.g. tuples and paths compare equal
+    return json.loads(json.dumps(module_params, default=str))
+
+
+def is_up_to_date(manifest_path, input_paths, module_params):
+    """
+    True if the manifest written by a previous run records the same inputs
+    (size and mtime), the same module parameters and outputs that are still
+    unchanged on disk
+    """
+    manifest_path = pathlib.Path(manifest_path)
+    if not manifest_path.exists():
+        return False
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        inputs = [file_identity(pp) for pp in input_paths]
+        outputs = [file_identity(oo['path']) for oo in manifest['outputs']]
+    except (OSError, ValueError, KeyError):
+        return False
+    return (
+        (manifest['inputs'] == inputs)
+        and (manifest['params'] == _normalize_params(module_params))
+        and (manifest['outputs'] == outputs)
+        and (len(outputs) > 0)
+    )
+
+
+def manifest_is_current(manifest_path):
+    """
+    True if the inputs and outputs recorded in the manifest are unchanged on
+    disk; unlike `is_up_to_date`, the module parameters are not compared
+    """
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        inputs = [file_identity(ii['path']) for ii in manifest['inputs']]
+        outputs = [file_identity(oo['path']) for oo in manifest['outputs']]
+    except (OSError, ValueError, KeyError):
+        return False
+    return (
+        (manifest['inputs'] == inputs)
+        and (manifest['outputs'] == outputs)
+        and (len(outputs) > 0)
+    )
+
+
+def write_manifest(manifest_path, input_paths, module_params, output_paths):
+    manifest_path = pathlib.Path(manifest_path)
+    manifest_path.parent.mkdir(exist_ok=True, parents=True)
+    manifest = {
+        'created': datetime.datetime.now().isoformat(),
+        'inputs': [file_identity(pp) for pp in input_paths],
+        'params': _normalize_params(module_params),
+        'outputs': [file_identity(pp) for pp in output_paths],
+    }
+    tmp_path = manifest_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    tmp_path.replace(manifest_path)
+    return manifest_path
 
 
 def init_run(
@@ -93,4 +599,527 @@ def init_run(
     file_config = process_arg_path(parsed_args.c)
 
 
-    return file_config, module_params, log_path
\ No newline at end of file
+    return file_config, module_params, log_path
+
+def write_slide_csv(config, csv_path):
+    config = set_config_defaults(config)
+    csv_path = pathlib.Path(csv_path)
+    csv_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(csv_path, 'w', newline='') as file_config_csv:
+        csv_writer = csv.DictWriter(
+            file_config_csv, fieldnames=['name', 'path', 'out_dir']
+        )
+        csv_writer.writeheader()
+        csv_writer.writerow({k: str(v) for k, v in config.items()})
+    return csv_path
+
+
+class SlidePipeline:
+    """
+    Run `steps` slide by slide as a chain; a slide enters the next step as
+    soon as its previous step finishes, each step having its own number of
+    concurrent jobs. `run_step(step, slide_idx)` must return a return code.
+    """
+
+    def __init__(
+        self, steps, names, run_step, max_jobs=None,
+        budget=None, job_resources=None
+    ):
+        self.steps = tuple(steps)
+        self.names = list(names)
+        self.run_step = run_step
+        if max_jobs is None:
+            max_jobs = {}
+        # no limit on a step if its max jobs is None
+        self.max_jobs = {
+            step: max(int(max_jobs.get(step) or len(self.names)), 1)
+            for step in self.steps
+        }
+        # `job_resources(step, slide_idx)` returns (RAM in GB, number of CPUs)
+        self.budget = budget
+        self.job_resources = job_resources
+        # optional hooks for sharing the slides with other nodes;
+        # `claim_step(step, slide_idx)` returns 'run', 'done' or 'wait' and
+        # `release_step(step, slide_idx, returncode)` is called after running
+        self.claim_step = None
+        self.release_step = None
+        self.retry_interval = 60
+        # called with (slide_idx, step, msg) on every progress report
+        self.on_report = None
+        self.status = {}
+        self._num_pending = 0
+        self._lock = threading.Condition()
+
+    def run(self):
+        import concurrent.futures
+
+        self.executors = {
+            step: concurrent.futures.ThreadPoolExecutor(
+                self.max_jobs[step], thread_name_prefix=step
+            )
+            for step in self.steps
+        }
+        self.start_time = time.perf_counter()
+        self._num_pending = len(self.names)
+        for idx in range(len(self.names)):
+            self._submit(idx, 0)
+        with self._lock:
+            while self._num_pending > 0:
+                self._lock.wait()
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.print_summary()
+        return int(any(
+            ss['returncode'] != 0 for ss in self.status.values()
+        ))
+
+    def _submit(self, slide_idx, step_idx):
+        step = self.steps[step_idx]
+        self.executors[step].submit(self._run_one, slide_idx, step_idx)
+
+    def _run_one(self, slide_idx, step_idx):
+        # runs in an executor whose futures are never read, an error of the
+        # claim/release hooks must still end the step or run() waits forever
+        try:
+            self._run_one_inner(slide_idx, step_idx)
+        except Exception as e:
+            step = self.steps[step_idx]
+            print(f"\nError: {step} on {self.names[slide_idx]} failed - {e!r}\n")
+            self._finish(
+                slide_idx, step_idx, 1, 0,
+                f"failed ({e!r}), skipping remaining steps"
+            )
+
+    def _run_one_inner(self, slide_idx, step_idx):
+        step = self.steps[step_idx]
+        if self.claim_step is not None:
+            claim = self.claim_step(step, slide_idx)
+            if claim == 'wait':
+                # being processed elsewhere, check again later
+                timer = threading.Timer(
+                    self.retry_interval, self._submit, (slide_idx, step_idx)
+                )
+                timer.daemon = True
+                timer.start()
+                return
+            if claim == 'done':
+                self._finish(slide_idx, step_idx, 0, 0, 'done by another node')
+                return
+        resources = None
+        if self.budget is not None:
+            try:
+                resources = self.job_resources(step, slide_idx)
+            except Exception as e:
+                print(f"\nWarning: cannot estimate resources of {step} on {self.names[slide_idx]} - {e!r}\n")
+                resources = (0, 1)
+            self.budget.acquire(*resources)
+        self._report(
+            slide_idx, step,
+            'started' if resources is None
+            else f"started (estimated {resources[0]:.1f} GB RAM, {resources[1]} CPUs)"
+        )
+        start_time = time.perf_counter()
+        try:
+            returncode = self.run_step(step, slide_idx)
+        except Exception as e:
+            print(f"\nError: {step} on {self.names[slide_idx]} failed - {e!r}\n")
+            returncode = 1
+        finally:
+            if resources is not None:
+                self.budget.release(*resources)
+            if self.release_step is not None:
+                self.release_step(step, slide_idx, returncode)
+        elapsed = time.perf_counter() - start_time
+        if returncode != 0:
+            msg = f"failed (return code {returncode}), skipping remaining steps"
+        else:
+            msg = f"finished in {datetime.timedelta(seconds=int(elapsed))}"
+        self._finish(slide_idx, step_idx, returncode, elapsed, msg)
+
+    def _finish(self, slide_idx, step_idx, returncode, elapsed, msg):
+        step = self.steps[step_idx]
+        with self._lock:
+            self.status[slide_idx] = {
+                'step': step, 'returncode': returncode, 'elapsed': elapsed
+            }
+        self._report(slide_idx, step, msg)
+        if (returncode == 0) and (step_idx + 1 < len(self.steps)):
+            self._submit(slide_idx, step_idx + 1)
+            return
+        with self._lock:
+            self._num_pending -= 1
+            self._lock.notify_all()
+
+    def _report(self, slide_idx, step, msg):
+        with self._lock:
+            num_done = sum(
+                (ss['step'] == self.steps[-1]) or (ss['returncode'] != 0)
+                for ss in self.status.values()
+            )
+        total_elapsed = datetime.timedelta(
+            seconds=int(time.perf_counter() - self.start_time)
+        )
+        print(
+            f"[{total_elapsed} | {num_done}/{len(self.names)} slides done]"
+            f" {self.names[slide_idx]} - {step} {msg}",
+            flush=True
+        )
+        if self.on_report is not None:
+            try:
+                self.on_report(slide_idx, step, msg)
+            except Exception as e:
+                print(f"\nWarning: cannot report progress - {e!r}\n", flush=True)
+
+    def print_summary(self):
+        print('\nSummary')
+        for idx, name in enumerate(self.names):
+            ss = self.status.get(idx)
+            if ss is None:
+                state = 'not started'
+            elif ss['returncode'] != 0:
+                state = f"failed at {ss['step']}"
+            else:
+                state = f"completed {ss['step']}"
+            print(f"    {name}: {state}")
+        print()
+
+
+def in_stage_worker():
+    return os.environ.get('ORION_STAGE_WORKER') == '1'
+
+
+def run_python_script(script_path, args, stdout=None):
+    """
+    Run `python script_path *args` and return the exit code. Inside a stage
+    worker the script is run in the current interpreter instead so that its
+    imports stay loaded between slides; the modules imported from the
+    script's own directory are dropped afterwards so that their state does not
+    carry over to the next slide
+    """
+    script_path = pathlib.Path(script_path)
+    args = [str(aa) for aa in args]
+    if not in_stage_worker():
+        return subprocess.run(
+            ['python', str(script_path), *args], stdout=stdout
+        ).returncode
+
+    import contextlib
+    import runpy
+    import traceback
+
+    sys_argv, sys_path = sys.argv, sys.path[:]
+    sys_modules = set(sys.modules)
+    sys.argv = [str(script_path), *args]
+    sys.path.insert(0, str(script_path.parent))
+    redirect = contextlib.nullcontext()
+    if stdout is not None:
+        redirect = contextlib.redirect_stdout(stdout)
+    returncode = 0
+    try:
+        with redirect:
+            runpy.run_path(str(script_path), run_name='__main__')
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.argv = sys_argv
+        sys.path[:] = sys_path
+        script_dir = script_path.resolve().parent
+        for name in set(sys.modules) - sys_modules:
+            module_path = getattr(sys.modules[name], '__file__', None)
+            if module_path and script_dir in pathlib.Path(module_path).resolve().parents:
+                del sys.modules[name]
+    return returncode
+
+
+class StageWorker:
+    """
+    A `stage_worker.py` process started once in a conda env; jobs (arguments
+    to command-<step>.py) are sent over a local socket
+    """
+
+    def __init__(self, step, env_path, startup_timeout=600):
+        import secrets
+        import socket
+
+        CURR = pathlib.Path(__file__).resolve().parent
+        self.step = step
+        token = secrets.token_hex(16)
+        launch_time = time.perf_counter()
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            listener.settimeout(1)
+            port = listener.getsockname()[1]
+            self.process = subprocess.Popen(
+                [
+                    'conda', 'run', '--no-capture-output',
+                    '-p', str(env_path),
+                    'python', str(CURR / 'stage_worker.py'),
+                    step, '--port', str(port)
+                ],
+                env={**os.environ, 'ORION_WORKER_TOKEN': token},
+                # `conda run` does not forward signals to python, the whole
+                # group is killed instead
+                start_new_session=True
+            )
+            while True:
+                if self.process.poll() is not None:
+                    raise RuntimeError(
+                        f"{step} worker exited during startup"
+                        f" (return code {self.process.returncode})"
+                    )
+                if time.perf_counter() - launch_time > startup_timeout:
+                    self.kill()
+                    raise RuntimeError(f"{step} worker did not start in time")
+                try:
+                    self.conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                self.conn.settimeout(None)
+                self.stream = self.conn.makefile('rw')
+                hello = self._recv()
+                if hello.get('token') == token:
+                    break
+                self.stream.close()
+                self.conn.close()
+        self.startup_time = time.perf_counter() - launch_time
+        print(
+            f"Started {step} worker in {self.startup_time:.1f} s"
+            f" (imports {hello['startup']:.1f} s)",
+            flush=True
+        )
+
+    def _recv(self):
+        line = self.stream.readline()
+        if not line:
+            raise RuntimeError(f"{self.step} worker connection closed")
+        return json.loads(line)
+
+    def run(self, argv):
+        self.stream.write(json.dumps({'argv': [str(aa) for aa in argv]}) + '\n')
+        self.stream.flush()
+        return self._recv()
+
+    def kill(self):
+        import signal
+
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def close(self, timeout=60):
+        try:
+            self.stream.write(json.dumps({'exit': True}) + '\n')
+            self.stream.flush()
+        except OSError:
+            pass
+        self.stream.close()
+        self.conn.close()
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print(f"\nWarning: {self.step} worker did not exit, killing it\n")
+            self.kill()
+
+
+class StageWorkerPool:
+    """
+    Hand out idle `StageWorker`s per step, starting new ones as needed. Jobs
+    on a worker whose connection broke return code 1 and the worker is
+    dropped
+    """
+
+    def __init__(self, env_paths):
+        self.env_paths = env_paths
+        self.idle = {step: queue.SimpleQueue() for step in env_paths}
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def run(self, step, argv):
+        try:
+            worker = self.idle[step].get_nowait()
+        except queue.Empty:
+            worker = StageWorker(step, self.env_paths[step])
+            with self._lock:
+                self.workers.append(worker)
+        try:
+            result = worker.run(argv)
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"\nError: {step} worker failed - {e!r}\n")
+            with self._lock:
+                self.workers.remove(worker)
+            worker.kill()
+            return 1
+        self.idle[step].put(worker)
+        return result['returncode']
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+class StepLease:
+    """
+    Exclusive claim on processing a (slide, step) shared by several machines
+    through a lease file next to the outputs. The holder refreshes the file's
+    mtime; a lease not refreshed within `timeout` seconds is considered held
+    by a dead node and can be taken over. Node clocks are assumed to be in
+    sync
+    """
+
+    def __init__(self, out_dir, name, step, timeout=600):
+        import socket
+
+        self.dir = pathlib.Path(out_dir) / name / '.lease'
+        self.path = self.dir / f"{step}.lease"
+        self.done_path = self.dir / f"{step}.done"
+        self.manifest_path = manifest_path(out_dir, name, step)
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        self.dir.mkdir(exist_ok=True, parents=True)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._break_stale():
+                return False
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+        with os.fdopen(fd, 'w') as lease_file:
+            json.dump({
+                'owner': self.owner,
+                'acquired': datetime.datetime.now().isoformat()
+            }, lease_file)
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._refresh, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _read_lease(self, path=None):
+        # (content, mtime) of the lease file, None if there is none
+        path = self.path if path is None else path
+        try:
+            with open(path) as lease_file:
+                content = lease_file.read()
+            return content, os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _is_owner(self):
+        lease = self._read_lease()
+        if lease is None:
+            return False
+        try:
+            return json.loads(lease[0]).get('owner') == self.owner
+        except ValueError:
+            return False
+
+    def _break_stale(self):
+        stale = self._read_lease()
+        if stale is None:
+            return True
+        age = time.time() - stale[1] / 1e9
+        if age < self.timeout:
+            return False
+        # another node may have broken the same lease and acquired a fresh
+        # one since it was read, so the renamed file must still be the stale
+        # lease; a fresh one is put back
+        moved_path = self.path.with_name(f"{self.path.name}.stale-{self.owner}")
+        try:
+            self.path.rename(moved_path)
+        except OSError:
+            return False
+        if self._read_lease(moved_path) != stale:
+            try:
+                # unlike rename, does not replace a lease created meanwhile
+                os.link(moved_path, self.path)
+            except OSError:
+                print(f"Could not restore lease {self.path} of another node")
+            moved_path.unlink()
+            return False
+        moved_path.unlink()
+        print(f"Took over expired lease {self.path} (last refreshed {int(age)} s ago)")
+        return True
+
+    def _refresh(self):
+        while not self._stop.wait(self.timeout / 4):
+            # a lease taken over by another node is not extended
+            if not self._is_owner():
+                continue
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def release(self, done=False, run_key=None):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if done:
+            with open(self.done_path, 'w') as done_file:
+                json.dump({'owner': self.owner, 'run_key': run_key}, done_file)
+        if not self._is_owner():
+            return
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def is_done(self, run_key):
+        # the record only says that a node of the same run finished the step,
+        # its outputs must also still match the inputs on disk
+        try:
+            with open(self.done_path) as done_file:
+                if json.load(done_file).get('run_key') != run_key:
+                    return False
+        except (OSError, ValueError):
+            return False
+        return manifest_is_current(self.manifest_path)
+
+    def clear_done(self):
+        self.done_path.unlink(missing_ok=True)
+
+
+class NodeStatus:
+    """
+    Progress of this node, rewritten as `<status_dir>/<host>-<pid>.json`
+    after every update so that all nodes' progress can be seen in one shared
+    directory
+    """
+
+    def __init__(self, status_dir, names):
+        import socket
+
+        self.status_dir = pathlib.Path(status_dir)
+        self.status_dir.mkdir(exist_ok=True, parents=True)
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.path = self.status_dir / f"{self.owner}.json"
+        self.names = list(names)
+        self.slides = {}
+        self.started = datetime.datetime.now().isoformat()
+        self._lock = threading.Lock()
+
+    def update(self, slide_idx, step, msg):
+        with self._lock:
+            self.slides[self.names[slide_idx]] = {
+                'step': step,
+                'status': msg,
+                'updated': datetime.datetime.now().isoformat()
+            }
+            tmp_path = self.path.with_suffix('.json.tmp')
+            with open(tmp_path, 'w') as status_file:
+                json.dump({
+                    'node': self.owner,
+                    'started': self.started,
+                    'updated': datetime.datetime.now().isoformat(),
+                    'slides': self.slides
+                }, status_file, indent=2)
+            tmp_path.replace(self.path)
@@ -0,0 +1,76 @@
+import argparse
+import importlib.util
+import json
+import os
+import pathlib
+import socket
+import sys
+import time
+import traceback
+
+START_TIME = time.perf_counter()
+
+
+def load_command_module(step):
+    CURR = pathlib.Path(__file__).resolve().parent
+    script_path = CURR / f"command-{step}.py"
+    spec = importlib.util.spec_from_file_location(
+        f"command_{step}", script_path
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def send(stream, message):
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description=(
+            'Long-lived worker that runs command-<step>.py jobs sent from'
+            ' run_all.py, keeping imports loaded between slides'
+        )
+    )
+    parser.add_argument('step', choices=('unmicst', 's3seg', 'quantification'))
+    parser.add_argument('--port', type=int, required=True)
+    parsed_args = parser.parse_args(argv[1:])
+
+    # scripts called by the step (S3segmenter, quantification) will also run
+    # in this interpreter, see `run_all_utils.run_python_script`
+    os.environ['ORION_STAGE_WORKER'] = '1'
+
+    module = load_command_module(parsed_args.step)
+    if hasattr(module, 'warm_up'):
+        module.warm_up()
+    startup_time = time.perf_counter() - START_TIME
+    print(f"{parsed_args.step} worker ready - startup {startup_time:.1f} s", flush=True)
+
+    with socket.create_connection(('127.0.0.1', parsed_args.port)) as conn:
+        stream = conn.makefile('rw')
+        send(stream, {
+            'token': os.environ.get('ORION_WORKER_TOKEN'),
+            'startup': startup_time
+        })
+        for line in stream:
+            job = json.loads(line)
+            if job.get('exit'):
+                break
+            start_time = time.perf_counter()
+            try:
+                returncode = module.main([module.__file__, *job['argv']]) or 0
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            elapsed = time.perf_counter() - start_time
+            print(f"{parsed_args.step} worker job done - {elapsed:.1f} s", flush=True)
+            send(stream, {'returncode': returncode, 'elapsed': elapsed})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import argparse
+import collections
+import json
+import pathlib
+import sys
+
+
+def read_records(log_paths):
+    records = []
+    for log_path in log_paths:
+        with open(log_path) as log_file:
+            for line in log_file:
+                # logs from older versions are plain text lines
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and ('step' in record):
+                    records.append(record)
+    return records
+
+
+def megapixels(record):
+    shape = record.get('shape')
+    if not shape:
+        return None
+    return shape[-2] * shape[-1] / 1e6
+
+
+def summarize(records):
+    groups = collections.defaultdict(list)
+    for record in records:
+        groups[record['step']].append(record)
+
+    rows = []
+    for step, step_records in groups.items():
+        elapsed = sum(rr['elapsed_s'] for rr in step_records)
+        mps = [
+            megapixels(rr) for rr in step_records
+            if megapixels(rr) is not None
+        ]
+        phase_times = collections.defaultdict(list)
+        for rr in step_records:
+            for phase, seconds in rr.get('phases_s', {}).items():
+                phase_times[phase].append(seconds)
+        peak_rss = [
+            rr['peak_rss_MB'] for rr in step_records
+            if rr.get('peak_rss_MB') is not None
+        ]
+        rows.append({
+            'step': step,
+            'slides': len(step_records),
+            'hosts': len({rr.get('host') for rr in step_records}),
+            'total_s': elapsed,
+            'mean_s': elapsed / len(step_records),
+            'MP/s': sum(mps) / elapsed if (mps and elapsed) else None,
+            'cpu_util': (
+                sum(rr.get('cpu_time_s') or 0 for rr in step_records) / elapsed
+                if elapsed else None
+            ),
+            'max_peak_rss_MB': max(peak_rss) if peak_rss else None,
+            'phases_mean_s': {
+                kk: sum(vv) / len(vv) for kk, vv in phase_times.items()
+            },
+        })
+    return rows
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f"{value:.1f}" if abs(value) >= 10 else f"{value:.2f}"
+    return str(value)
+
+
+def print_table(rows):
+    columns = [
+        'step', 'slides', 'hosts', 'total_s', 'mean_s', 'MP/s', 'cpu_util',
+        'max_peak_rss_MB'
+    ]
+    table = [columns] + [[format_value(rr[cc]) for cc in columns] for rr in rows]
+    widths = [max(len(row[ii]) for row in table) for ii in range(len(columns))]
+    for row in table:
+        print('  '.join(vv.rjust(ww) for vv, ww in zip(row, widths)))
+
+    for rr in rows:
+        if not rr['phases_mean_s']:
+            continue
+        print()
+        print(f"{rr['step']} - mean phase time (s)")
+        width = max(len(kk) for kk in rr['phases_mean_s'])
+        for phase, seconds in rr['phases_mean_s'].items():
+            share = seconds / rr['mean_s'] if rr['mean_s'] else 0
+            print(f"    {phase.ljust(width)}  {format_value(seconds):>8}  ({share:.0%})")
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description=(
+            'Aggregate the JSON-lines logs written by the processing steps'
+            ' into per-step throughput tables'
+        )
+    )
+    parser.add_argument(
+        'log_paths', nargs='+', type=pathlib.Path,
+        help='log files, e.g. ../.log/unmicst.log'
+    )
+    parser.add_argument(
+        '--step', nargs='+', default=None,
+        help='only summarize these steps'
+    )
+    parsed_args = parser.parse_args(argv[1:])
+
+    records = read_records(parsed_args.log_paths)
+    if parsed_args.step:
+        records = [rr for rr in records if rr['step'] in parsed_args.step]
+    if len(records) == 0:
+        print('No telemetry records found')
+        return 1
+    print_table(summarize(records))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
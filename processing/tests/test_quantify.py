@@ -0,0 +1,76 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import skimage.measure
+import tifffile
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks import synthetic  # noqa: E402
+from module_scripts import quantify  # noqa: E402
+
+
+FILE_TILE_SIZE = 1024
+
+
+@pytest.fixture(scope='module')
+def slide(tmp_path_factory):
+    # 2x2 file tiles; the last row and column of tiles are only partly used
+    return synthetic.make_synthetic_slide(
+        tmp_path_factory.mktemp('slide'), shape=(1100, 1300), num_channels=3,
+        tile_size=FILE_TILE_SIZE
+    )
+
+
+def expected_table(img_path, mask_path, channel_names):
+    img = tifffile.imread(img_path)
+    mask = tifffile.imread(mask_path)
+    regions = skimage.measure.regionprops(mask)
+    table = {'CellID': [rr.label for rr in regions]}
+    for name, channel in zip(channel_names, img):
+        table[name] = [
+            channel[tuple(rr.coords.T)].mean() for rr in regions
+        ]
+    table['X_centroid'] = [rr.centroid[1] for rr in regions]
+    table['Y_centroid'] = [rr.centroid[0] for rr in regions]
+    for kk, vv in quantify.MORPHOLOGY.items():
+        table[kk] = [rr[vv] for rr in regions]
+    return pd.DataFrame(table)
+
+
+@pytest.mark.parametrize('region', [
+    # inside a single tile that is not the first one
+    (1024, 1100, 1024, 1300),
+    (100, 900, 1030, 1200),
+    (1050, 1090, 10, 500),
+    # across tiles
+    (1000, 1100, 1000, 1300),
+])
+def test_tile_reader_region(slide, region):
+    y0, y1, x0, x1 = region
+    expected = tifffile.imread(slide['image'], key=1)[y0:y1, x0:x1]
+    reader = quantify.TileReader(slide['image'])
+    try:
+        np.testing.assert_array_equal(reader.read(1, y0, y1, x0, x1), expected)
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize('tile_size', [FILE_TILE_SIZE, 700])
+def test_quantify_matches_regionprops(slide, tile_size):
+    # with tile_size=1024, every tile but the first lies inside a single
+    # file tile that is not the first one
+    channel_names = quantify.read_channel_names(slide['markers'])
+    mask_paths = [slide['cellRing'], slide['nucleiRing']]
+    tables = quantify.quantify(
+        slide['image'], mask_paths, channel_names, tile_size=tile_size
+    )
+    for mask_path, table in zip(mask_paths, tables):
+        expected = expected_table(slide['image'], mask_path, channel_names)
+        assert list(table.columns) == list(expected.columns)
+        pd.testing.assert_frame_equal(
+            table, expected, check_dtype=False, rtol=1e-9
+        )